@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Python 3 Program to benchmark parts of the Roomba map/telemetry code
+This is for debugging only! use at your own risk...
+'''
+import argparse
+import json
+import logging as log
+import random
+import time
+
+import roomba
+from roomba import make_transparent, transparent, encode_image
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    pass
+
+# state reported by an s9 on connection (from README.md)
+sample_state = '''{"state":{"reported":{"batPct": 100, "batteryType": "F12432712", "batInfo": {"mDate": "2020-8-19", "mName": "F12432712", "mDaySerial": 560, "mData": "303031303035303300000000000000000000000000", "mLife": "0BE90B5410120C8D4A97000A0719EDBA0121FD531F110000000003B300000000", "cCount": 13, "afCount": 0}, "batAuthEnable": true, "bbchg": {"nChatters": 0, "nKnockoffs": 0, "nLithF": 0, "nChgOk": 40, "aborts": [0, 0, 0], "smberr": 0}, "bbchg3": {"estCap": 3474, "nAvail": 150, "hOnDock": 792, "avgMin": 65}, "bbmssn": {"aCycleM": 30, "nMssnF": 33, "nMssnC": 19, "nMssnOk": 26, "aMssnM": 62, "nMssn": 79}, "bbnav": {"aMtrack": 8, "nGoodLmrks": 18, "aGain": 11, "aExpo": 33}, "bbpause": {"pauses": [31, 31, 2, 31, 2, 31, 31, 31, 31, 31]}, "bbrun": {"nOvertemps": 0, "nCBump": 0, "nWStll": 0, "nMBStll": 1748, "nEvacs": 48, "nPanics": 116, "nPicks": 225, "nOpticalDD": 3, "nPiezoDD": 0, "nScrubs": 3, "nStuck": 103, "sqft": 51, "min": 39, "hr": 21, "nCliffsF": 7111, "nCliffsR": 0}, "bbswitch": {"nBumper": 36637, "nDrops": 706, "nDock": 52, "nSpot": 71, "nClean": 238}, "bbsys": {"min": 7, "hr": 905}, "behaviorFwk": true, "bin": {"present": true, "full": false}, "binPause": true, "cap": {"carpetBoost": 1, "binFullDetect": 2, "dockComm": 1, "edge": 0, "maps": 3, "pmaps": 5, "tLine": 2, "area": 1, "eco": 1, "multiPass": 2, "pose": 1, "team": 1, "pp": 0, "lang": 2, "5ghz": 1, "prov": 3, "sched": 1, "svcConf": 1, "ota": 2, "log": 2, "langOta": 0, "tileScan": 1}, "carpetBoost": true, "cleanMissionStatus": {"cycle": "none", "phase": "charge", "expireM": 0, "rechrgM": 0, "error": 0, "notReady": 0, "mssnM": 0, "expireTm": 0, "rechrgTm": 0, "mssnStrtTm": 1612533591, "initiator": "schedule", "nMssn": 79}, "cleanSchedule2": [{"enabled": true, "type": 0, "start": {"day": [5], "hour": 9, "min": 0}, "cmd": {"command": "start", "params": {"team": {"team_id": "watA6YF2"}}}}, {"enabled": true, "type": 0, "start": {"day": [1], "hour": 9, "min": 0}, "cmd": {"command": "start", "params": {"team": {"team_id": "lmoTXfAD"}}}}, {"enabled": true, "type": 0, "start": {"day": [2, 4], "hour": 9, "min": 0}, "cmd": {"command": "start", "ordered": 1, "pmap_id": "3w7_8thVQomB2wTwI7PSVQ", "regions": [{"region_id": "5", "type": "rid"}], "user_pmapv_id": "210110T000133"}}, {"enabled": true, "type": 0, "start": {"day": [3], "hour": 9, "min": 0}, "cmd": {"command": "start"}}], "cloudEnv": "prod", "connected": true, "country": "CA", "deploymentState": 0, "dock": {"known": true, "pn": "unknown", "state": 301, "id": "XXXXXXXXXXXXXXXXXXXXXXXXXXXXX", "fwVer": "3.3.6"}, "evacAllowed": true, "ecoCharge": false, "hwPartsRev": {"csscID": 1, "mobBrd": 7, "mobBlid": "XXXXXXXXXXXXXXXXXXXXXXXXXXXX", "navSerialNo": "CE00A1X2V", "wlan0HwAddr": "50:14:79:72:2e:7a", "NavBrd": 0}, "hwDbgr": {"swVer": "", "hw": "", "status": 0}, "langs": null, "langs2": {"sVer": "1.0", "dLangs": {"ver": "0.20", "langs": ["cs-CZ", "da-DK", "de-DE", "en-GB", "en-US", "es-ES", "es-XL", "fi-FI", "fr-CA", "fr-FR", "he-IL", "it-IT", "ja-JP", "ko-KR", "nb-NO", "nl-NL", "pl-PL", "pt-BR", "pt-PT", "ru-RU", "sv-SE", "zh-CN", "zh-HK", "zh-TW"]}, "sLang": "en-US", "aSlots": 0}, "language": null, "lastCommand": {"command": "start", "initiator": "schedule", "time": 1612533600, "params": {"team": {"team_id": "ypRG6GK1"}}, "robot_id": null, "select_all": null}, "lastDisconnect": 2, "mapUploadAllowed": true, "missionTelemetry": {"aux_comms": 1, "bat_stats": 1, "camera_settings": 1, "map_hypotheses": 1, "map_load": 1, "vital_stats": 1, "vslam_report": 1}, "mssnNavStats": {"nMssn": 79, "gLmk": 18, "lmk": 3, "reLc": 0, "plnErr": "none", "mTrk": 8, "kdp": 1, "sfkdp": 0, "nmc": 2, "nmmc": 1, "nrmc": 0, "mpSt": "idle", "l_drift": 0, "h_drift": 0, "l_squal": 90, "h_squal": 0}, "name": "Downstairs", "noAutoPasses": false, "noPP": false, "openOnly": false, "pmapLearningAllowed": true, "pmaps": [{"QpjbGUqlZv-Cmf-Geq9HAw": "210205T153623"}], "pmapCL": true, "pmapFmt": "3", "rankOverlap": 15, "sceneRecog": 1, "schedHold": false, "secureBoot": {"log": 2, "flip": 0, "sbl1Ver": "B3.2.02_PPUB", "stublVer": "B3.2.02_PPUB", "efuse": 1, "blType": 1, "enforce": 2, "lastRst": "200000000040", "recov": "linux+2.4.2+soho-release-rt320+11", "idSwitch": 0}, "sku": "s955020", "softwareVer": "soho+3.12.8+soho-release-420+12", "subModSwVer": {"nav": "soho-nav+3.12.8+ubuntu-HEAD-09318572a78+12", "mob": "3.12.8+ubuntu-HEAD-09318572a78+12", "bmp": "2.0.1+ubuntu-HEAD-09318572a78+12", "pwr": "1.14.27+ubuntu-HEAD-09318572a78+12", "sft": "1.2.0+Soho-Builds/Soho-Certified-Safety/soho-safety-ca6f27d09c6+27", "mobBtl": "4.2", "linux": "linux+3.8.0.2+soho-release-420+12", "con": "3.8.61-@8419265a/ubuntu"}, "svcEndpoints": {"svcDeplId": "v011"}, "timezone": "America/Toronto", "tls": {"tzbChk": 1, "privKType": 2, "lcCiphers": [0, 0, 0, 0, 0, 0, 0, 0, 0, 50380848]}, "twoPass": false, "tz": {"events": [{"dt": 1604232000, "off": -300}, {"dt": 1615705201, "off": -240}, {"dt": 1636264801, "off": -300}], "ver": 9}, "vacHigh": false}}}'''
+
+# properties looked up for each message
+lookup_keys = ['pose', 'batPct', 'cleanMissionStatus', 'cycle', 'phase', 'mssnM',
+               'expireM', 'rechrgM', 'sqft', 'sku', 'bin_full', 'tankLvl']
+
+def parse_args():
+    #-------- Command Line -----------------
+    parser = argparse.ArgumentParser(
+        description='Benchmark Roomba map and telemetry handling')
+    parser.add_argument(
+        '-r', '--repeat',
+        action='store',
+        type=int,
+        default=3,
+        help='number of times to repeat each test, best time is reported (default: %(default)s)')
+    parser.add_argument(
+        '-s', '--mapsize',
+        action='store',
+        type=str,
+        default="(800,1500)",
+        help='size of map image to use for tests (default: "%(default)s")')
+    parser.add_argument(
+        '-i', '--image',
+        action='store',
+        type=str,
+        default=None,
+        help='map image to use for encode test, eg res/map.png, default is '
+             'a generated mission map (default: %(default)s)')
+    parser.add_argument(
+        '-l', '--log',
+        action='store',
+        type=str,
+        default=None,
+        help='roomba log file to take payloads from for decode test, eg '
+             'roomba.log, default is sample and generated mission messages '
+             '(default: %(default)s)')
+    parser.add_argument(
+        'test',
+        action='store',
+        type=str,
+        nargs='*',
+        default=['transparent'],
+        help='tests to run: transparent, encode, lookup, topics, decode, trace (default: %(default)s)')
+    return parser.parse_args()
+
+def best_time(func, *args, repeat=3, **kwargs):
+    '''
+    run func repeat times, return best time in seconds, and the last result
+    '''
+    best = None
+    for i in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def mission_map(size=(800,1500), colour=(124, 252, 0, 255), segments=2000, seed=1):
+    '''
+    draw a fake mission map (random walk) on a white background
+    '''
+    random.seed(seed)
+    image = Image.new('RGBA', size, (255, 255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    x_y = (size[0] // 2, size[1] // 2)
+    for i in range(segments):
+        new_x_y = (min(max(0, x_y[0] + random.randint(-40, 40)), size[0]-1),
+                   min(max(0, x_y[1] + random.randint(-40, 40)), size[1]-1))
+        draw.line([x_y, new_x_y], fill=colour, width=25)
+        x_y = new_x_y
+    return image
+
+def make_transparent_loop(image, colour=None):
+    '''
+    original per pixel version of make_transparent() for comparison
+    '''
+    image = image.convert("RGBA")
+    datas = image.getdata()
+    newData = []
+    for item in datas:
+        # white (ish)
+        if item[0] >= 254 and item[1] >= 254 and item[2] >= 254:
+            newData.append(transparent)
+        else:
+            if colour:
+                newData.append(colour)
+            else:
+                newData.append(item)
+
+    image.putdata(newData)
+    return image
+
+def test_transparent(arg):
+    '''
+    compare make_transparent() implementations on a full size map image
+    '''
+    size = arg.mapsize
+    image = mission_map(size)
+    log.info('make_transparent: map size: {}'.format(size))
+    tests = [('loop', make_transparent_loop),
+             ('pil', roomba._make_transparent_pil)]
+    if roomba.HAVE_NUMPY:
+        tests.append(('numpy', roomba._make_transparent_numpy))
+    for colour in [None, (0, 0, 0, 255)]:
+        reference = None
+        for name, func in tests:
+            elapsed, result = best_time(func, image, colour, repeat=arg.repeat)
+            if reference is None:
+                reference = (elapsed, result.tobytes())
+                speedup = ''
+            else:
+                speedup = ', x{:.1f} faster, identical: {}'.format(reference[0]/elapsed, result.tobytes() == reference[1])
+            log.info('  {:6} colour: {:16} {:8.3f}s{}'.format(name, str(colour), elapsed, speedup))
+    log.info('  make_transparent() is using: {}'.format('numpy' if roomba.HAVE_NUMPY else 'pil'))
+
+def test_encode(arg):
+    '''
+    compare live map encoder options, time and file size
+    '''
+    if arg.image:
+        image = Image.open(arg.image).convert('RGBA')
+    else:
+        # live map (map_notext) is lines on a transparent background
+        image = make_transparent(mission_map(arg.mapsize))
+    log.info('encode: map size: {}'.format(image.size))
+    options = [('png',  {}),
+               ('png',  {'compress_level': 1}),
+               ('png',  {'compress_level': 9}),
+               ('png',  {'optimize': True}),
+               ('png',  {'quantize': True}),
+               ('png',  {'quantize': True, 'compress_level': 1}),
+               ('webp', {}),
+               ('webp', {'quality': 0}),
+               ('jpg',  {'quality': 85})]
+    reference = None
+    for format, params in options:
+        try:
+            elapsed, data = best_time(encode_image, image, format, repeat=arg.repeat, **params)
+        except (IOError, KeyError) as e:
+            log.info('  {:4} {:40} not supported: {}'.format(format, str(params), e))
+            continue
+        if reference is None:
+            reference = (elapsed, len(data))
+        log.info('  {:4} {:40} {:8.3f}s {:9} bytes ({:3.0f}% time, {:3.0f}% size)'.format(
+                 format, str(params), elapsed, len(data),
+                 100 * elapsed / reference[0], 100 * len(data) / reference[1]))
+
+def recursive_lookup(search_dict, key, cap=False):
+    '''
+    original recursive master_state lookup for comparison
+    '''
+    for k, v in search_dict.items():
+        if cap:
+            if k == 'cap':
+                return recursive_lookup(v, key, False)
+        elif k == key:
+            return v
+        elif isinstance(v, dict) and k != 'cap':
+            val = recursive_lookup(v, key, cap)
+            if val is not None:
+                return val
+    return None
+
+def test_lookup(arg):
+    '''
+    compare recursive and indexed master_state property lookups
+    '''
+    state = json.loads(sample_state)
+    index = roomba.state_index(state)
+    index.rebuild()
+    loops = 1000
+    log.info('lookup: {} keys in state, {} lookups'.format(sum(len(paths) for paths in index.paths.values()),
+                                                           loops * len(lookup_keys)))
+
+    def lookup(func):
+        for i in range(loops):
+            values = [func(key) for key in lookup_keys]
+        return values
+
+    recursive, values = best_time(lookup, lambda key: recursive_lookup(state, key), repeat=arg.repeat)
+    indexed, index_values = best_time(lookup, index.lookup, repeat=arg.repeat)
+    per_lookup = 1e6 / (loops * len(lookup_keys))
+    log.info('  recursive {:8.3f}s {:6.2f}us per lookup'.format(recursive, recursive * per_lookup))
+    log.info('  indexed   {:8.3f}s {:6.2f}us per lookup, x{:.1f} faster, identical: {}'.format(
+             indexed, indexed * per_lookup, recursive / indexed, values == index_values))
+
+def decode_topics_original(state, publish, feedback, prefix=None):
+    '''
+    original recursive decode_topics() for comparison
+    '''
+    for k, v in state.items():
+        if isinstance(v, dict):
+            if prefix is None:
+                decode_topics_original(v, publish, feedback, k)
+            else:
+                decode_topics_original(v, publish, feedback, prefix+"_"+k)
+        else:
+            if isinstance(v, list):
+                newlist = []
+                for i in v:
+                    if isinstance(i, dict):
+                        for ki, vi in i.items():
+                            newlist.append((str(ki), vi))
+                    else:
+                        if not isinstance(i, str):
+                            i = str(i)
+                        newlist.append(i)
+                v = newlist
+            if prefix is not None:
+                k = prefix+"_"+k
+            k = k.replace("state_reported_","")
+            publish('{}/{}'.format(feedback, k), str(v))
+
+def test_topics(arg):
+    '''
+    compare original decode_topics() with cached topic names (topic_map)
+    '''
+    state = json.loads(sample_state)
+    pose = {'state': {'reported': {'pose': {'theta': 90, 'point': {'x': 100, 'y': -20}}}}}
+    feedback = '/roomba/feedback/Downstairs'
+    loops = 1000
+    for name, message in [('full state', state), ('pose', pose)]:
+        def original():
+            published = []
+            for i in range(loops):
+                decode_topics_original(message, lambda topic, msg: published.append((topic, msg)), feedback)
+            return published
+
+        def cached():
+            published = []
+            topics = roomba.topic_map(feedback)
+            for i in range(loops):
+                published.extend(topics.items(message))
+            return published
+
+        original_time, original_published = best_time(original, repeat=arg.repeat)
+        cached_time, cached_published = best_time(cached, repeat=arg.repeat)
+        log.info('topics: {}, {} values, {} messages'.format(name, len(original_published) // loops, loops))
+        log.info('  original {:8.3f}s'.format(original_time))
+        log.info('  cached   {:8.3f}s x{:.1f} faster, identical: {}'.format(
+                 cached_time, original_time / cached_time, original_published == cached_published))
+
+def decode_payload_original(payload, indent=31, raw=False):
+    '''
+    original decode_payload() for comparison
+    '''
+    try:
+        json_data = json.loads(
+            payload.decode("utf-8").replace(":nan", ":NaN").\
+            replace(":inf", ":Infinity").replace(":-inf", ":-Infinity"))
+        if not isinstance(json_data, dict):
+            return json_data, dict(json_data)
+        json_data_string = "\n".join((indent * " ") + i for i in \
+            (json.dumps(json_data, indent = 2)).splitlines())
+        formatted_data = "Decoded JSON: \n%s" % (json_data_string)
+    except ValueError:
+        formatted_data = payload
+    if raw:
+        formatted_data = payload
+    return formatted_data, dict(json_data)
+
+def payload_corpus(filename=None):
+    '''
+    list of (topic, payload) from "Received Roomba Data: topic, b'payload'"
+    lines in a roomba log file, or sample state and generated mission messages
+    '''
+    from ast import literal_eval
+    topic = '$aws/things/XXXXXXXXXXXXXXXXXXXXXXXXXXXXX/shadow/update'
+    if filename:
+        corpus = []
+        with open(filename) as f:
+            for line in f:
+                data = line.partition('Received Roomba Data: ')[2].strip()
+                if not data:
+                    continue
+                topic, sep, payload = data.partition(', ')
+                try:
+                    payload = literal_eval(payload)
+                except (ValueError, SyntaxError):
+                    continue
+                if isinstance(payload, bytes):
+                    corpus.append((topic, payload))
+        return corpus
+    random.seed(1)
+    corpus = [(topic, sample_state.encode())]
+    for i in range(200):
+        pose = {'theta': random.randint(-180, 180), 'point': {'x': random.randint(-500, 500), 'y': random.randint(-500, 500)}}
+        status = {'cycle': 'clean', 'phase': 'run', 'mssnM': i // 20, 'sqft': i // 10, 'error': 0}
+        corpus.append((topic, json.dumps({'state': {'reported': {'pose': pose}}}).encode()))
+        if i % 10 == 0:
+            corpus.append((topic, json.dumps({'state': {'reported': {'cleanMissionStatus': status, 'batPct': 100 - i // 10}}}).encode()))
+        if i % 50 == 0:
+            corpus.append((topic, b'{"state":{"reported":{"signal":{"rssi":-45,"snr":43,"noise":-88},"bbchg3":{"avgMin":nan}}}}'))
+    return corpus
+
+def test_decode(arg):
+    '''
+    compare original decode_payload() and eager log formatting with bytes
+    decoding and lazy log strings, at INFO (logged) and WARNING (not logged)
+    '''
+    import io
+    from types import SimpleNamespace
+    corpus = payload_corpus(arg.log)
+    if not corpus:
+        log.warning('decode: no payloads found in {}'.format(arg.log))
+        return
+    logger = log.getLogger('benchmark.decode')
+    logger.propagate = False
+    logger.addHandler(log.StreamHandler(io.StringIO()))
+    loops = max(1, 5000 // len(corpus))
+    log.info('decode: {} payloads, {} bytes, {} loops'.format(len(corpus), sum(len(p) for t, p in corpus), loops))
+    for pretty_print in [False, True]:
+        settings = SimpleNamespace(master_indent=0, raw=False)
+
+        def original():
+            for i in range(loops):
+                for topic, payload in corpus:
+                    log_string, json_data = decode_payload_original(payload)
+                    if pretty_print:
+                        logger.info("%-{:d}s : %s".format(0) % (topic, log_string))
+                    else:
+                        logger.info("Received Roomba Data: {}, {}".format(str(topic), str(payload)))
+            return json_data
+
+        def fast():
+            for i in range(loops):
+                for topic, payload in corpus:
+                    log_string, json_data = roomba.Roomba.decode_payload(settings, topic, payload)
+                    if pretty_print:
+                        logger.info("%-*s : %s", 0, topic, log_string)
+                    else:
+                        logger.info("Received Roomba Data: %s, %s", topic, payload)
+            return json_data
+
+        for level in [log.INFO, log.WARNING]:
+            logger.setLevel(level)
+            original_time, original_data = best_time(original, repeat=arg.repeat)
+            fast_time, fast_data = best_time(fast, repeat=arg.repeat)
+            per_message = 1e6 / (loops * len(corpus))
+            log.info('  pretty_print: {}, level: {}'.format(pretty_print, log.getLevelName(level)))
+            log.info('    original {:8.3f}s {:6.2f}us per message'.format(original_time, original_time * per_message))
+            log.info('    fast     {:8.3f}s {:6.2f}us per message, x{:.1f} faster, identical: {}'.format(
+                     fast_time, fast_time * per_message, original_time / fast_time, original_data == fast_data))
+
+class null_mqtt():
+    '''
+    mqtt client that discards published items
+    '''
+    def publish(self, topic, message):
+        pass
+
+def test_trace(arg):
+    '''
+    per message cost of the telemetry path (decode, merge, publish, state
+    machine) with the log at DEBUG, INFO and WARNING, and with the telemetry
+    trace log disabled
+    '''
+    import io
+    corpus = payload_corpus(arg.log)
+    if not corpus:
+        log.warning('trace: no payloads found in {}'.format(arg.log))
+        return
+    logger = log.getLogger('benchmark.Roomba')
+    logger.propagate = False
+    logger.addHandler(log.StreamHandler(io.StringIO()))
+    loops = max(1, 5000 // len(corpus))
+    log.info('trace: {} payloads, {} loops'.format(len(corpus), loops))
+    for name, level, trace in [('DEBUG', log.DEBUG, True),
+                               ('INFO', log.INFO, True),
+                               ('INFO, trace off', log.INFO, False),
+                               ('WARNING', log.WARNING, True)]:
+        logger.setLevel(log.WARNING)    #don't log creating the Roomba
+        myroomba = roomba.Roomba('127.0.0.1', 'blid', 'password', roombaName='Benchmark', log=logger)
+        myroomba.mqttc = null_mqtt()
+        myroomba.brokerFeedback = '/roomba/feedback/Benchmark'
+        myroomba.set_trace(trace)
+        logger.setLevel(level)
+
+        def telemetry():
+            for i in range(loops):
+                for topic, payload in corpus:
+                    log_string, json_data = myroomba.decode_payload(topic, payload)
+                    myroomba.dict_merge(myroomba.master_state, json_data)
+                    myroomba.trace.info("Received Roomba Data: %s, %s", topic, payload)
+                    myroomba.decode_topics(json_data)
+            return myroomba.master_state
+
+        elapsed, state = best_time(telemetry, repeat=arg.repeat)
+        log.info('  {:16s} {:8.3f}s {:6.2f}us per message'.format(name, elapsed, 1e6 * elapsed / (loops * len(corpus))))
+
+tests = {'transparent'  : test_transparent,
+         'encode'       : test_encode,
+         'lookup'       : test_lookup,
+         'topics'       : test_topics,
+         'decode'       : test_decode,
+         'trace'        : test_trace}
+
+def main():
+    from ast import literal_eval
+    arg = parse_args()
+    log.basicConfig(level=log.INFO, format='%(message)s')
+    arg.mapsize = tuple(literal_eval(arg.mapsize))[:2]
+    for test in arg.test:
+        if test not in tests:
+            log.warning('unknown test: {}, valid tests are: {}'.format(test, ', '.join(tests)))
+            continue
+        tests[test](arg)
+
+if __name__ == '__main__':
+    main()
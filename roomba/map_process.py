@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Map worker process for Roomba maps
+Runs the CPU intensive (whole map) stages of map drawing, encoding images and
+finding contours, in a separate process, so that several Roombas can draw
+maps in parallel, without holding the GIL needed to process messages.
+The image (or array) is copied into a shared memory frame buffer, only the
+function, arguments and result are sent through the pipe.
+'''
+
+import logging
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+image_modes = ['RGBA', 'RGB', 'L']  #image modes that can be shared
+
+def worker(conn):
+    '''
+    worker process main loop, receives (func, frame, args, kwargs), where
+    frame describes the image or array in shared memory (or is None), and
+    sends back the result of func (or the exception)
+    '''
+    shm = None
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        func, frame, data, args, kwargs = request
+        try:
+            if frame is not None:
+                name, kind, shape, format = frame
+                if shm is None or shm.name != name:
+                    if shm is not None:
+                        shm.close()
+                    shm = shared_memory.SharedMemory(name=name)
+                if kind == 'image':
+                    data = Image.frombuffer(format, shape, shm.buf, 'raw', format, 0, 1)
+                else:
+                    data = np.ndarray(shape, dtype=format, buffer=shm.buf)
+            result = func(data, *args, **kwargs)
+            data = None     #release shared memory
+        except Exception as e:
+            data = None
+            result = RuntimeError('{}: {}'.format(type(e).__name__, e))
+        conn.send(result)
+    if shm is not None:
+        shm.close()
+
+class map_process():
+    '''
+    Map worker process for one Roomba
+    call(func, data, *args, **kwargs) runs func(data, *args, **kwargs) in the
+    worker process, and returns the result. func must be a module level
+    function. If data is a PIL image, or numpy uint8 array, it is passed
+    through shared memory.
+    '''
+    
+    VERSION = __version__ = "1.0"
+    
+    def __init__(self, name='map_process', log=None):
+        if log:
+            self.log = log
+        else:
+            self.log = logging.getLogger("Roomba.{}".format(__name__))
+        self.name = name
+        self.context = multiprocessing.get_context('spawn')   #don't fork threads
+        self.process = None
+        self.conn = None
+        self.shm = None             #frame buffer
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def start(self):
+        if self.process is None:
+            self.conn, child_conn = self.context.Pipe()
+            self.process = self.context.Process(target=worker, args=(child_conn,), name=self.name, daemon=True)
+            self.process.start()
+            child_conn.close()
+            self.log.info('MAP: started map process: {} (pid: {})'.format(self.name, self.process.pid))
+
+    def stop(self, timeout=10):
+        with self.lock:
+            if self.process is not None:
+                try:
+                    self.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+                self.process.join(timeout)
+                if self.process.is_alive():
+                    self.process.terminate()
+                self.conn.close()
+                self.process = self.conn = None
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = None
+        self.log.info('MAP: map process stopped: {}'.format(self.stats()))
+
+    def frame_buffer(self, size):
+        '''
+        shared memory of at least size bytes
+        '''
+        if self.shm is None or self.shm.size < size:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        return self.shm
+
+    def put_frame(self, data):
+        '''
+        copy data into the frame buffer, return frame description (or None
+        if data has to be sent through the pipe)
+        '''
+        if isinstance(data, Image.Image) and data.mode in image_modes:
+            raw = data.tobytes()
+            shm = self.frame_buffer(len(raw))
+            shm.buf[:len(raw)] = raw
+            return (shm.name, 'image', data.size, data.mode)
+        if isinstance(data, np.ndarray) and data.dtype == np.uint8:
+            shm = self.frame_buffer(max(1, data.nbytes))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+            return (shm.name, 'array', data.shape, data.dtype.str)
+        return None
+
+    def call(self, func, data, *args, **kwargs):
+        with self.lock:
+            self.start()
+            frame = self.put_frame(data)
+            self.conn.send((func, frame, None if frame else data, args, kwargs))
+            self.calls += 1
+            try:
+                result = self.conn.recv()
+            except EOFError:
+                # worker died, start a new one next time
+                self.process.join()
+                self.conn.close()
+                self.process = self.conn = None
+                raise RuntimeError('map process {} exited'.format(self.name))
+        if isinstance(result, Exception):
+            self.errors += 1
+            raise result
+        return result
+
+    def stats(self):
+        return {'calls'     : self.calls,
+                'errors'    : self.errors,
+                'pid'       : self.process.pid if self.process else None,
+                'buffer'    : self.shm.size if self.shm else 0}
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Mission telemetry recorder for Roomba
+Records the pose (x, y, theta), phase, battery, sqft and error of a mission in
+compact typed arrays (one array per column), and appends them to a binary file
+per mission in chunks. Each column of a chunk is stored contiguously, and
+8 byte aligned, so the file can be memory mapped and read (with numpy) without
+copying or parsing text logs.
+
+File format (little endian):
+    magic           b'RMBREC\\x00\\x01'
+    chunks, each a 16 byte header (4 byte type, uint32 length, 8 bytes
+    padding) followed by length bytes of data, padded to 8 bytes:
+    b'META'         json: roomba name, start time, columns (name, typecode)
+    b'CODE'         json: {code: phase} for phases first seen in this chunk
+    b'DATA'         length is the number of rows, followed by each column
+                    (rows * itemsize bytes, padded to 8 bytes), missing
+                    values are stored as the minimum value of the type
+'''
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+MAGIC = b'RMBREC\x00\x01'
+CHUNK_HEADER = struct.Struct('<4sI8x')
+
+# column name, array typecode
+columns = [('time',     'd'),   #seconds since epoch
+           ('x',        'i'),
+           ('y',        'i'),
+           ('theta',    'h'),
+           ('phase',    'B'),   #index into phases
+           ('batPct',   'h'),
+           ('sqft',     'i'),
+           ('error',    'h')]
+none_values = {'i': -2**31, 'h': -2**15}   #values stored for None (by typecode)
+limits = {'i': (-2**31 + 1, 2**31 - 1),     #range of recorded values (by typecode)
+          'h': (-2**15 + 1, 2**15 - 1)}
+max_phases = 255                            #phase code for phases after the first 255 (read as None)
+
+def padded(size):
+    return (size + 7) & ~7
+    
+def typed(value, typecode):
+    '''
+    value as an int that fits typecode (clamped to its range), or the None
+    value if it is None or not a number
+    '''
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return none_values[typecode]
+    low, high = limits[typecode]
+    return min(max(value, low), high)
+
+class mission_recorder():
+    '''
+    Records one mission to filename. add() appends a row to the current chunk
+    (and returns True when the chunk is full), flush() appends the chunk to the
+    file, close() flushes and closes the file. add() can be called from one
+    thread while flush() or close() run in others, chunks are written one at
+    a time, in the order they were filled.
+    '''
+
+    VERSION = __version__ = "1.0"
+
+    def __init__(self, filename, name=None, chunk=256, log=None):
+        if log:
+            self.log = log
+        else:
+            self.log = logging.getLogger("Roomba.{}".format(__name__))
+        self.filename = filename
+        self.chunk = chunk          #rows per chunk
+        self.typecodes = dict(columns)
+        self.lock = threading.Lock()            #current chunk
+        self.write_lock = threading.Lock()      #file
+        self.rows = self.new_chunk()
+        self.phases = {}            #phase: code
+        self.new_phases = {}        #codes to write with the next chunk
+        self.count = 0              #rows recorded
+        self.chunks = 0             #chunks written
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.write_chunk(b'META', json.dumps({'name'    : name,
+                                              'start'   : time.time(),
+                                              'version' : self.VERSION,
+                                              'columns' : columns}).encode())
+        self.log.info('Recording mission to: {}'.format(filename))
+
+    def new_chunk(self):
+        return {name: array(typecode) for name, typecode in columns}
+
+    def write_chunk(self, kind, data, length=None):
+        self.file.write(CHUNK_HEADER.pack(kind, len(data) if length is None else length))
+        self.file.write(data)
+        self.file.write(b'\x00' * (padded(len(data)) - len(data)))
+
+    def phase_code(self, phase):
+        code = self.phases.get(phase)
+        if code is None:
+            if len(self.phases) >= max_phases:
+                return max_phases
+            code = self.phases[phase] = len(self.phases)
+            self.new_phases[code] = phase
+        return code
+
+    def add(self, pose=None, phase=None, batPct=None, sqft=None, error=None, timestamp=None):
+        '''
+        add a row, pose is a Roomba pose dict ({'theta': t, 'point': {'x': x, 'y': y}}).
+        Values are converted to int (and clamped to the column type) before
+        anything is added, values that are not numbers are recorded as None.
+        '''
+        try:
+            x, y, theta = pose['point']['x'], pose['point']['y'], pose['theta']
+        except (KeyError, TypeError):
+            x = y = theta = None
+        try:
+            timestamp = time.time() if timestamp is None else float(timestamp)
+        except (TypeError, ValueError):
+            timestamp = time.time()
+        if not isinstance(phase, (str, type(None))):
+            phase = str(phase)
+        values = [('x', x), ('y', y), ('theta', theta), ('batPct', batPct), ('sqft', sqft), ('error', error)]
+        values = [(name, typed(value, self.typecodes[name])) for name, value in values]
+        with self.lock:
+            rows = self.rows
+            rows['time'].append(timestamp)
+            rows['phase'].append(self.phase_code(phase))
+            for name, value in values:
+                rows[name].append(value)
+            self.count += 1
+            return len(rows['time']) >= self.chunk
+
+    def flush(self):
+        with self.write_lock:
+            self.write_rows()
+            
+    def write_rows(self):
+        '''
+        write the current chunk (call with write_lock held)
+        '''
+        with self.lock:
+            rows, self.rows = self.rows, self.new_chunk()
+            new_phases, self.new_phases = self.new_phases, {}
+        length = len(rows['time'])
+        if not length or self.file is None:
+            return
+        if new_phases:
+            self.write_chunk(b'CODE', json.dumps(new_phases).encode())
+        data = []
+        for name, typecode in columns:
+            values = rows[name]
+            if sys.byteorder == 'big':
+                values.byteswap()
+            size = len(values) * values.itemsize
+            data.append(values.tobytes() + b'\x00' * (padded(size) - size))
+        self.write_chunk(b'DATA', b''.join(data), length)
+        self.file.flush()
+        self.chunks += 1
+
+    def close(self):
+        with self.write_lock:
+            self.write_rows()
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+        self.log.info('Recorded mission: {}: {}'.format(self.filename, self.stats()))
+
+    def stats(self):
+        return {'rows'      : self.count,
+                'chunks'    : self.chunks,
+                'phases'    : len(self.phases),
+                'bytes'     : os.path.getsize(self.filename) if os.path.exists(self.filename) else 0}
+
+class mission_reader():
+    '''
+    Reads a mission recording (while it is being recorded, if you like).
+    The file is memory mapped, with numpy, chunks() returns numpy arrays that
+    are views of the file (not copies), without numpy, they are arrays
+    (array.array).
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.meta = {}
+        self.phases = {}            #code: phase
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a mission recording'.format(filename))
+            size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self.offsets = []           #(offset, rows) of DATA chunks
+        self.index()
+
+    def index(self):
+        '''
+        find the chunks in the file (complete chunks only)
+        '''
+        offset = len(MAGIC)
+        size = len(self.map)
+        while offset + CHUNK_HEADER.size <= size:
+            kind, length = CHUNK_HEADER.unpack_from(self.map, offset)
+            start = offset + CHUNK_HEADER.size
+            if kind == b'DATA':
+                end = start + sum(padded(length * array(typecode).itemsize) for name, typecode in self.meta['columns'])
+            else:
+                end = start + padded(length)
+            if end > size:
+                break
+            if kind == b'META':
+                self.meta = json.loads(self.map[start:start+length])
+            elif kind == b'CODE':
+                self.phases.update({int(k): v for k, v in json.loads(self.map[start:start+length]).items()})
+            elif kind == b'DATA':
+                self.offsets.append((start, length))
+            offset = end
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(rows for offset, rows in self.offsets)
+
+    def chunks(self):
+        '''
+        yield each chunk as a dict of column name: array
+        '''
+        for offset, rows in self.offsets:
+            chunk = {}
+            for name, typecode in self.meta['columns']:
+                size = rows * array(typecode).itemsize
+                if HAVE_NUMPY:
+                    chunk[name] = np.frombuffer(self.map, dtype=np.dtype(typecode).newbyteorder('<'), count=rows, offset=offset)
+                else:
+                    chunk[name] = array(typecode, self.map[offset:offset+size])
+                    if sys.byteorder == 'big':
+                        chunk[name].byteswap()
+                offset += padded(size)
+            yield chunk
+
+    def columns(self):
+        '''
+        dict of column name: all rows (concatenated chunks)
+        '''
+        result = {name: [] for name, typecode in self.meta['columns']}
+        for chunk in self.chunks():
+            for name, values in chunk.items():
+                result[name].append(values)
+        if HAVE_NUMPY:
+            return {name: np.concatenate(values) if values else np.array([], dtype=typecode)
+                    for (name, values), (n, typecode) in zip(result.items(), self.meta['columns'])}
+        return {name: sum(values, array(typecode)) for (name, values), (n, typecode) in zip(result.items(), self.meta['columns'])}
+
+    def rows(self):
+        '''
+        yield each row as a dict, phase is decoded, missing values are None
+        '''
+        nones = {name: none_values.get(typecode) for name, typecode in self.meta['columns']}
+        for chunk in self.chunks():
+            lists = {name: values.tolist() for name, values in chunk.items()}
+            for i in range(len(lists['time'])):
+                row = {name: None if values[i] == nones[name] else values[i] for name, values in lists.items()}
+                row['phase'] = self.phases.get(row['phase'])
+                yield row
+
+    def poses(self):
+        '''
+        yield (time, Roomba pose dict) each time the pose changes, for
+        re-drawing a map
+        '''
+        last = None
+        for row in self.rows():
+            pose = (row['x'], row['y'], row['theta'])
+            if row['theta'] is not None and pose != last:
+                yield row['time'], {'theta': row['theta'], 'point': {'x': row['x'], 'y': row['y']}}
+            last = pose
@@ -4,15 +4,26 @@
 '''
 Python 3.6 Program to test roomba mapping by replaying a log file
 This is for debugging only! use at your own risk...
+A sidecar index (<log file>.idx) of the mission start offsets and times in the
+log is built the first time a log is replayed (and updated if the log grows),
+so replays can seek straight to a mission. Messages are replayed at a fixed
+interval, or at a speed factor of the times in the log, either to an MQTT
+broker (simulate topic), or directly into a Roomba instance's ingest queue.
 '''
 import re
 from datetime import datetime
+import asyncio
+import json
 import os
 import paho.mqtt.client as mqtt
 import time
 import argparse
 import logging as log
 
+index_version = 1
+checkpoint_seconds = 600    #time checkpoints in index (seconds apart)
+max_wait = 9                #max seconds between messages (simulation resets after 10s)
+
 end_mission = '{"state":{"reported":{"cleanMissionStatus":{"cycle":"none","phase":"charge","expireM":0,"rechrgM":0,"error":0,"notReady":0,"mssnM":0,"sqft":0,"initiator":"schedule","nMssn":0}}}}'
 
 def valid_datetime_type(arg_datetime_str):
@@ -52,6 +63,59 @@ def parse_args():
         action='store_true',
         default = False,
         help='Start Mission immediately (default: %(default)s)')
+    parser.add_argument(
+        '-k', '--mission',
+        action='store',
+        type=int,
+        default=None,
+        help='replay mission number (see --list), seeks straight to it (default: None)')
+    parser.add_argument(
+        '-L', '--list',
+        action='store_true',
+        default = False,
+        help='list the missions in the log and exit (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--reindex',
+        action='store_true',
+        default = False,
+        help='rebuild the log index (default: %(default)s)')
+    parser.add_argument(
+        '-x', '--speed',
+        action='store',
+        type=float,
+        default=0,
+        help='replay speed, 1 is real time (the times in the log), 10 is ten '
+             'times faster, 0 replays messages --interval seconds apart (default: %(default)s)')
+    parser.add_argument(
+        '-i', '--interval',
+        action='store',
+        type=float,
+        default=0.5,
+        help='seconds between messages if --speed is 0 (default: %(default)s)')
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        default = False,
+        help='replay directly into a Roomba instance (drawing maps in '
+             '--mappath), instead of publishing to a broker (default: %(default)s)')
+    parser.add_argument(
+        '-M', '--mappath',
+        action='store',
+        type=str,
+        default=".",
+        help='Location to store maps to with --direct (default: %(default)s)')
+    parser.add_argument(
+        '-ms', '--mapsize',
+        action='store',
+        type=str,
+        default="(800,1500,0,0,0,0)",
+        help='Map Size, Dock offset and skew for the map with --direct (default: %(default)s)')
+    parser.add_argument(
+        '-I', '--iconpath',
+        action='store',
+        type=str,
+        default=default_icon_path,
+        help='location of Roomba icons with --direct (default: %(default)s)')
     parser.add_argument(
         '-C', '--brokerCommand',
         action='store',
@@ -112,28 +176,150 @@ def publish(mqttc, topic, msg):
         log.info('publishing: {}: {}'.format(topic, msg))
         mqttc.publish(topic, msg)
     
-def lines_from_file(filename, roomba_name='', startdate=None):
+def line_time(line):
+    '''
+    date/time of a log line (None if it has no date), format 2021-01-13 14:57:06
+    Lines starting with [2021-01-13 14:57:06,123] (the roomba_direct.py log
+    format) are parsed directly, other lines are searched for the date.
+    '''
+    if line[:1] == '[' and line[11:12] == ' ':
+        try:
+            return datetime.fromisoformat(line[1:20])
+        except ValueError:
+            pass
+    match = re.search(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', line)
+    if match:
+        return datetime.strptime(match.group(), '%Y-%m-%d %H:%M:%S')
+    return None
+
+def line_roomba(line):
+    '''
+    Roomba name of a log line (from the logger name, eg Roomba.Upstairs.trace)
+    '''
+    start = line.find('(Roomba.')
+    if start == -1:
+        return None
+    name = line[start+8:line.find(')', start)].strip()
+    return name.split('.')[0]
+
+class log_index():
+    '''
+    Index of a log file, saved in <log file>.idx. missions is a list of
+    (offset, date/time, roomba name) of each 'New Mission' line, times is a
+    list of (offset, date/time) at least checkpoint_seconds apart. If the log
+    has grown since the index was saved, the new part is indexed.
+    '''
+    
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        self.index_file = '{}.idx'.format(filename)
+        self.size = 0           #bytes of log indexed
+        self.missions = []
+        self.times = []
+        if not rebuild:
+            self.load()
+        self.update()
+        
+    def load(self):
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index.get('version') != index_version or index['size'] > os.path.getsize(self.filename):
+                # log has been rotated (or old index)
+                return
+            with open(self.filename, 'rb') as f:
+                f.seek(index['size'] - len(index['tail']))
+                if f.read(len(index['tail'])).decode('latin-1') != index['tail']:
+                    return
+            self.size = index['size']
+            self.missions = [(offset, datetime.fromisoformat(date), name) for offset, date, name in index['missions']]
+            self.times = [(offset, datetime.fromisoformat(date)) for offset, date in index['times']]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.info('rebuilding index {}: {}'.format(self.index_file, e))
+            
+    def update(self):
+        size = os.path.getsize(self.filename)
+        if size == self.size:
+            return
+        log.info('indexing file: {} from offset {}'.format(self.filename, self.size))
+        start = time.perf_counter()
+        last = self.times[-1][1] if self.times else None
+        with open(self.filename, 'rb') as f:
+            f.seek(self.size)
+            offset = self.size
+            for raw in f:
+                if raw[-1:] != b'\n':
+                    break       #incomplete last line
+                line = raw.decode('utf-8', 'replace')
+                date = line_time(line)
+                if date:
+                    if last is None or (date - last).total_seconds() >= checkpoint_seconds:
+                        self.times.append((offset, date))
+                        last = date
+                    if 'New Mission' in line:
+                        self.missions.append((offset, date, line_roomba(line)))
+                offset += len(raw)
+            self.size = offset
+            f.seek(max(0, offset - 64))
+            tail = f.read(offset - max(0, offset - 64)).decode('latin-1')  #one char per byte
+        log.info('indexed {} missions in {:.2f}s'.format(len(self.missions), time.perf_counter() - start))
+        self.save(tail)
+        
+    def save(self, tail):
+        try:
+            with open(self.index_file, 'w') as f:
+                json.dump({'version'    : index_version,
+                           'size'       : self.size,
+                           'tail'       : tail,
+                           'missions'   : [(offset, str(date), name) for offset, date, name in self.missions],
+                           'times'      : [(offset, str(date)) for offset, date in self.times]}, f)
+        except OSError as e:
+            log.warning('unable to save index {}: {}'.format(self.index_file, e))
+            
+    def roomba_missions(self, roomba_name=''):
+        return [m for m in self.missions if not roomba_name or m[2] == roomba_name]
+            
+    def time_offset(self, startdate):
+        '''
+        offset of last checkpoint before startdate
+        '''
+        offset = 0
+        for checkpoint, date in self.times:
+            if date >= startdate:
+                break
+            offset = checkpoint
+        return offset
+
+def lines_from_file(filename, roomba_name='', startdate=None, offset=0):
     '''
     date format 2021-01-13 14:57:06
+    lines of the file starting at offset
     '''
-    log.info('reading file: {}'.format(filename))
-    date = None
-    with open(filename) as f:
-        for line in f:
+    log.info('reading file: {} from offset: {}'.format(filename, offset))
+    name = 'Roomba.{}'.format(roomba_name)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            line = raw.decode('utf-8', 'replace')
             if startdate:
-                match = re.search(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', line)
-                if match:
-                    date = datetime.strptime(match.group(), '%Y-%m-%d %H:%M:%S')
-            if startdate and date and date < startdate:
-                continue
+                date = line_time(line)
+                if date is None or date < startdate:
+                    continue
+                startdate = None    #log is in date order
             #log.info('line: {}'.format(line))
             if roomba_name:
-                if 'Roomba.{}'.format(roomba_name) in line:
+                if name in line:
                     yield line
             else:
                 yield line
   
 def replay_data(gen, mission=False):
+    '''
+    yield (date/time, topic, message) for each Roomba message, topic is None
+    if it is not in the log line
+    '''
     for line in gen:
         if 'New Mission' in line:
             mission = True
@@ -143,8 +329,89 @@ def replay_data(gen, mission=False):
                 if data:
                     message = line[data:].replace("'","").rstrip()
                     #log.info(message)
-                    yield message                    
+                    topic = None
+                    received = line.find('Received Roomba Data: ')
+                    if received != -1:
+                        topic = line[received+22:data].split(', ')[0]
+                    yield line_time(line), topic, message
+
+class replay_timer():
+    '''
+    delay before each message, interval seconds apart if speed is 0, else the
+    time between the messages in the log divided by speed (at most max_wait
+    seconds)
+    '''
     
+    def __init__(self, speed=0, interval=0.5, max_wait=max_wait):
+        self.speed = speed
+        self.interval = interval
+        self.max_wait = max_wait
+        self.last = None            #date/time of last message
+        self.due = None             #time.monotonic() last message was due
+        
+    def delay(self, date):
+        now = time.monotonic()
+        if self.due is None:
+            wait = 0
+        elif not self.speed or date is None or self.last is None:
+            wait = self.interval
+        else:
+            wait = min(max(0, (date - self.last).total_seconds() / self.speed), self.max_wait)
+        if date is not None:
+            self.last = date
+        # keep to the schedule, even if publishing is slow
+        self.due = now if self.due is None else max(now, self.due + wait)
+        return self.due - now
+
+def replay_to_broker(mqttc, brokerCommand, data_gen, timer):
+    count = 0
+    for date, topic, data in data_gen:
+        time.sleep(timer.delay(date))
+        publish(mqttc, brokerCommand, data)
+        count += 1
+    return count
+
+class replay_message():
+    '''
+    message to put in a Roomba ingest queue (like a paho MQTTMessage)
+    '''
+    
+    __slots__ = ('topic', 'payload')
+    
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+async def replay_to_roomba(myroomba, data_gen, timer):
+    '''
+    put the messages straight into myroomba's ingest queue (waits for the
+    queue to empty if it is full, so no messages are dropped or coalesced)
+    '''
+    count = 0
+    for date, topic, data in data_gen:
+        await asyncio.sleep(timer.delay(date))
+        if myroomba.q.qsize() >= myroomba.q.size:
+            await myroomba.q.join()
+        myroomba.q.add(replay_message(topic or 'replay', data.encode()))
+        count += 1
+    await myroomba.q.join()
+    return count
+
+async def replay_direct(arg, data_gen, timer):
+    from ast import literal_eval
+    from roomba import Roomba
+    myroomba = Roomba('127.0.0.1', 'replay', 'replay', roombaName=arg.pubroombaName or 'replay')
+    await myroomba.enable_map(enable=True,
+                              mapSize=literal_eval(arg.mapsize),
+                              mapPath=arg.mappath,
+                              iconPath=arg.iconpath)
+    start = time.perf_counter()
+    try:
+        count = await replay_to_roomba(myroomba, data_gen, timer)
+    except asyncio.CancelledError:
+        count = None
+    log.info('replayed {} messages in {:.1f}s, final state: {}'.format(count, time.perf_counter() - start, myroomba.current_state))
+    log.info('Queue stats: {}'.format(myroomba.queue_stats()))
 
 def main():
     arg = parse_args()
@@ -161,10 +428,44 @@ def main():
         arg.pubroombaName = arg.roombaName
     brokerCommand = '{}{}'.format(arg.brokerCommand, '/{}'.format(arg.pubroombaName) if arg.pubroombaName else '')
     
-    log.info('reading file: {}, Roomba: {}, publish to {}  Mission Date: {}'.format(arg.log, arg.roombaName, brokerCommand, arg.missionStart))
+    index = log_index(arg.log, arg.reindex)
+    missions = index.roomba_missions(arg.roombaName)
+    if arg.list:
+        for number, (offset, date, name) in enumerate(missions, 1):
+            log.info('mission {:3d}: {} Roomba: {} (offset {})'.format(number, date, name, offset))
+        return
+    
+    # seek straight to the mission
+    offset = 0
+    startdate = arg.missionStart
+    if arg.mission is not None:
+        if not 1 <= arg.mission <= len(missions):
+            log.warning('mission {} not found, there are {} missions in {}'.format(arg.mission, len(missions), arg.log))
+            return
+        offset, startdate, name = missions[arg.mission-1]
+        startdate = None
+    elif not arg.start_mission:
+        missions = [m for m in missions if startdate is None or m[1] >= startdate]
+        if not missions:
+            log.warning('no New Mission found in {}'.format(arg.log))
+            return
+        offset, startdate, name = missions[0]
+        startdate = None
+    elif startdate:
+        offset = index.time_offset(startdate)
     
-    file_reader = lines_from_file(arg.log, arg.roombaName, arg.missionStart)
+    log.info('reading file: {}, Roomba: {}, publish to {}  Mission Date: {}'.format(arg.log, arg.roombaName, 'Roomba instance' if arg.direct else brokerCommand, arg.missionStart))
+    
+    file_reader = lines_from_file(arg.log, arg.roombaName, startdate, offset)
     data_gen = replay_data(file_reader, arg.start_mission)
+    timer = replay_timer(arg.speed, arg.interval)
+    
+    if arg.direct:
+        try:
+            asyncio.run(replay_direct(arg, data_gen, timer))
+        except KeyboardInterrupt:
+            log.info('program exit')
+        return
     
     if arg.broker:
         mqttc = setup_client(arg.user, arg.password)
@@ -174,9 +475,8 @@ def main():
         mqttc = None
         
     try:
-        for data in data_gen:
-            publish(mqttc, brokerCommand, data)
-            time.sleep(0.5) #do not make longer than 9 seconds!, and 0.5 is as low as you can go
+        count = replay_to_broker(mqttc, brokerCommand, data_gen, timer)
+        log.info('replayed {} messages'.format(count))
 
     except KeyboardInterrupt:
         log.info('program exit')
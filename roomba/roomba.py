@@ -43,9 +43,13 @@ __version__ = "2.0.2"
 import asyncio
 from ast import literal_eval
 #from collections import OrderedDict, Mapping
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from collections.abc import Mapping
 from password import Password
+import base64
 import datetime
+import hashlib
 import json
 import math
 import logging
@@ -55,34 +59,48 @@ import ssl
 import sys
 import time
 import textwrap
+import threading
 import io
+import random
 import configparser
 
 # Import trickery
 global HAVE_CV2
 global HAVE_MQTT
 global HAVE_PIL
+global HAVE_NUMPY
+global HAVE_SHM
 HAVE_CV2 = False
 HAVE_MQTT = False
 HAVE_PIL = False
+HAVE_NUMPY = False
+HAVE_SHM = False
 try:
     import paho.mqtt.client as mqtt
     HAVE_MQTT = True
 except ImportError:
     print("paho mqtt client not found")
 try:
-    import cv2
     import numpy as np
+    HAVE_NUMPY = True
+    import cv2
     HAVE_CV2 = True
 except ImportError:
     print("CV or numpy module not found, falling back to PIL")
 
 try:
-    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps, ImageColor
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps, ImageColor, ImageChops
     HAVE_PIL = True
 except ImportError:
     print("PIL module not found, maps are disabled")
 
+try:
+    # python 3.8+
+    from multiprocessing import shared_memory
+    HAVE_SHM = True
+except ImportError:
+    print("shared memory not available, the map process is disabled")
+
 try:
     # ANTIALIAS is deprecated and has been removed in Pillow 10.0.0
     LANCZOS = Image.LANCZOS
@@ -96,32 +114,157 @@ if sys.version_info < (3, 7):
     
 transparent = (0, 0, 0, 0)  #transparent colour
 
+white_threshold = 254       #r, g and b at or above this are white (ish)
+
 def make_transparent(image, colour=None):
     '''
-    take image and make white areas transparent
+    take image and make white areas transparent, if colour is given, all
+    other areas are set to colour
     return transparent image
     '''
+    if HAVE_NUMPY:
+        return _make_transparent_numpy(image, colour)
+    return _make_transparent_pil(image, colour)
+    
+def _make_transparent_numpy(image, colour=None):
+    '''
+    numpy version of make_transparent, masks the whole image in one pass
+    '''
+    data = np.array(image.convert("RGBA"))
+    keep = np.minimum(np.minimum(data[..., 0], data[..., 1]), data[..., 2]) < white_threshold
+    # treat each RGBA pixel as one 32 bit value, so white pixels can be
+    # zeroed (made transparent) with a single multiply
+    pixels = data.view(np.uint32)[..., 0]
+    if colour:
+        pixels[...] = np.array(colour, dtype=np.uint8).view(np.uint32)[0]
+    pixels *= keep
+    return Image.fromarray(data)
+    
+def _make_transparent_pil(image, colour=None):
+    '''
+    PIL version of make_transparent (used if numpy is not installed), builds
+    a mask of the white areas using channel lookups
+    '''
     image = image.convert("RGBA")
-    datas = image.getdata()
-    newData = []
-    for item in datas:
-        # white (ish)
-        if item[0] >= 254 and item[1] >= 254 and item[2] >= 254:
-            newData.append(transparent)
-        else:
-            if colour:
-                newData.append(colour)
-            else:
-                newData.append(item)
-
-    image.putdata(newData)
+    lut = [0] * white_threshold + [255] * (256 - white_threshold)
+    r, g, b, _ = [channel.point(lut) for channel in image.split()]
+    white = ImageChops.multiply(ImageChops.multiply(r, g), b)
+    if colour:
+        image = Image.new("RGBA", image.size, colour)
+    image.paste(transparent, None, white)
     return image
     
+def alpha_paste(image, icon, position=(0,0), box=None):
+    '''
+    alpha composite icon onto image (in place) at position, if box
+    (x0, y0, x1, y1) is given, only the part of icon inside box is drawn.
+    Only the icon area is processed, not the whole image.
+    '''
+    if icon.mode != 'RGBA':
+        icon = icon.convert('RGBA')
+    x0 = max(0, position[0])
+    y0 = max(0, position[1])
+    x1 = min(image.size[0], position[0] + icon.size[0])
+    y1 = min(image.size[1], position[1] + icon.size[1])
+    if box is not None:
+        x0, y0 = max(x0, box[0]), max(y0, box[1])
+        x1, y1 = min(x1, box[2]), min(y1, box[3])
+    if x0 >= x1 or y0 >= y1:
+        return
+    region = (x0, y0, x1, y1)
+    overlay = icon.crop((x0 - position[0], y0 - position[1],
+                         x1 - position[0], y1 - position[1]))
+    image.paste(Image.alpha_composite(image.crop(region), overlay), region)
+
+image_formats = {'png': 'PNG', 'webp': 'WEBP', 'jpg': 'JPEG', 'jpeg': 'JPEG'}
+
+def encode_image(image, format='png', compress_level=None, optimize=False,
+                 quantize=False, quality=None):
+    '''
+    encode image as format (png, webp or jpg), return bytes
+    png:  compress_level (0-9, PIL default 6), optimize, quantize (to a 256
+          colour palette, with transparency)
+    webp: lossless, quality is compression effort (0-100)
+    jpg:  quality (0-100), transparent areas are made white
+    '''
+    format = image_formats.get(format.lower(), format.upper())
+    params = {}
+    if format == 'PNG':
+        if compress_level is not None:
+            params['compress_level'] = compress_level
+        if optimize:
+            params['optimize'] = True
+        if quantize and image.mode in ['RGB', 'RGBA']:
+            # method 2 (fast octree) is the only built in method that keeps alpha
+            image = image.quantize(256, method=2)
+    elif format == 'WEBP':
+        params['lossless'] = True
+        if quality is not None:
+            params['quality'] = quality
+    elif format == 'JPEG':
+        if image.mode != 'RGB':
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, None, image.convert('RGBA'))
+            image = background
+        if quality is not None:
+            params['quality'] = quality
+    output = io.BytesIO()
+    image.save(output, format, **params)
+    return output.getvalue()
+    
+def find_contours(image, mode, method):
+    '''
+    Version independent find contours routine. Works with OpenCV 2, 3, 4 or
+    later (only OpenCV 3 returns the image as well).
+    Returns modified image (with contours applied), contours list, hierarchy
+    '''
+    im = image.copy()
+    result = cv2.findContours(im,mode,method)
+    contours, hierarchy = result[-2:]
+    return result[0] if len(result) == 3 else im, contours, hierarchy
+        
+def outline_contour(edgedata):
+    '''
+    external contour of edgedata (2D uint8 array), None if there isn't one
+    (or it's too small)
+    '''
+    _, contours, _ = find_contours(edgedata,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0 or contours[0] is None: return None
+    if len(contours[0]) < 5: return None
+    return contours[0]
+    
+def final_map_contours(edgedata, draw_edges):
+    '''
+    find all contours of edgedata (2D uint8 array), return the longest one
+    approximated to lines (draw_edges is the max deviation from a line, as a
+    fraction of the perimeter), and a list of the other contours.
+    Returns None if there is no usable contour.
+    NOTE: this is CPU intensive!
+    '''
+    _, contours, _ = find_contours(edgedata,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
+    contours = list(contours)
+    max_perimeter = 0
+    max_index = None
+    for i, cnt in enumerate(contours):
+        perimeter = cv2.arcLength(cnt,True)
+        if perimeter >= max_perimeter:
+            max_index = i   # get the contour with maximum length
+            max_perimeter = perimeter
+    if max_index is None: return None
+    max_contour = contours.pop(max_index)  # remove max contour from list
+    if len(max_contour) < 5: return None
+    approx = cv2.approxPolyDP(max_contour, draw_edges * max_perimeter, True)
+    return approx, contours
+
 class icons():
     '''
     Roomba icons object
+    Rotated icons are kept in a LRU cache keyed by (icon name, angle, size),
+    angles are rounded to angle_step degrees, and at most cache_size rotated
+    icons are kept.
     '''
-    def __init__(self, base_icon=None, angle=0, fnt=None, size=(50,50), log=None):
+    def __init__(self, base_icon=None, angle=0, fnt=None, size=(50,50), log=None,
+                       cache_size=720, angle_step=1):
         #super().__init__()
         if log:
             self.log = log
@@ -133,10 +276,15 @@ class icons():
         self.base_icon = base_icon
         if self.base_icon is None:
             self.base_icon = self.draw_base_icon()
+        self.cache_size = cache_size
+        self.angle_step = angle_step
+        self.rotated = OrderedDict()    #LRU cache of rotated icons
+        self.hits = self.misses = self.evictions = 0
         
         self.init_dict()
                         
     def init_dict(self):
+        self.clear_cache()
         self.icons = {  'roomba'    : self.create_icon('roomba'),
                         'stuck'     : self.create_icon('stuck'),
                         'cancelled' : self.create_icon('cancelled'),
@@ -148,6 +296,42 @@ class icons():
                         
     def __getitem__(self, name):
         return self.icons.get(name)
+        
+    def rotate(self, name, angle):
+        '''
+        return icon rotated by angle (rounded to angle_step degrees) from the
+        cache, rotating and caching it if it isn't there.
+        '''
+        icon = self.icons.get(name)
+        if icon is None:
+            return None
+        angle = int(round(angle / self.angle_step) * self.angle_step) % 360
+        key = (name, angle, icon.size)
+        rotated = self.rotated.get(key)
+        if rotated is not None:
+            self.hits += 1
+            self.rotated.move_to_end(key)
+            return rotated
+        self.misses += 1
+        rotated = icon.rotate(angle, expand=False)
+        self.rotated[key] = rotated
+        if len(self.rotated) > self.cache_size:
+            self.rotated.popitem(last=False)
+            self.evictions += 1
+        return rotated
+        
+    def clear_cache(self):
+        self.rotated.clear()
+        
+    def cache_info(self):
+        '''
+        return rotated icon cache statistics
+        '''
+        return {'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions,
+                'size'      : len(self.rotated),
+                'max_size'  : self.cache_size}
                         
     def set_font(self, fnt):
         self.fnt = fnt
@@ -155,11 +339,14 @@ class icons():
         
     def set_angle(self, angle):
         self.angle = angle
+        self.clear_cache()
         
     def create_default_icon(self, name, size=None):
+        self.clear_cache()
         self.icons[name] = self.create_icon(name, size)
             
     def load_icon_file(self, name, filename, size=None):
+        self.clear_cache()
         try:
             if not size:
                 size = self.size
@@ -268,7 +455,830 @@ class icons():
         icon = icon.rotate(180-self.angle, expand=False)
         return icon
 
+class map_compositor():
+    '''
+    Map compositing object
+    Keeps a cached composite of the map layers (rotated 180 degrees, as the
+    map is upside down), and only re-composites the area that has changed
+    since the last update (the dirty box), so the cost of an update depends
+    on the size of the change, not the size of the map.
+    '''
+    def __init__(self, log=None):
+        if log:
+            self.log = log
+        else:
+            self.log = logging.getLogger("Roomba.{}".format(__name__))
+        self.image = None       #cached composite, rotated 180 degrees
+        self.static = ()        #layers used to make self.image
+        self.dirty = None       #bounding box of changed area (x0, y0, x1, y1)
+        self.full = 0           #number of full redraws
+        self.partial = 0        #number of partial redraws
+
+    def invalidate(self):
+        '''
+        force full redraw on next update
+        '''
+        self.image = None
+        self.dirty = None
+
+    def add_dirty(self, box):
+        '''
+        add box (x0, y0, x1, y1) to the area to re-composite on next update
+        '''
+        box = [int(v) for v in box]
+        if self.dirty is None:
+            self.dirty = box
+        else:
+            self.dirty = [min(self.dirty[0], box[0]), min(self.dirty[1], box[1]),
+                          max(self.dirty[2], box[2]), max(self.dirty[3], box[3])]
+
+    def layers_changed(self, static):
+        return len(static) != len(self.static) or any(a is not b for a, b in zip(static, self.static))
+
+    def render(self, layers, static=None):
+        '''
+        layers is a list of RGBA images of the same size (bottom layer first),
+        None entries are skipped. static is a list of layers that are only
+        changed in place in the dirty area (default all layers), if any of
+        them are replaced, the whole map is re-composited.
+        returns (image, changed) where image is the composite rotated 180
+        degrees, and changed is True if image was updated.
+        NOTE: image is updated in place by the next render()
+        '''
+        layers = [layer for layer in layers if layer is not None]
+        if static is None:
+            static = layers
+        size = layers[0].size
+        if self.image is None or self.image.size != size or self.layers_changed(static):
+            out = layers[0]
+            for layer in layers[1:]:
+                out = Image.alpha_composite(out, layer)
+            self.image = out.rotate(180, expand=False)
+            self.static = tuple(static)
+            self.dirty = None
+            self.full += 1
+            return self.image, True
+
+        if self.dirty is None:
+            return self.image, False
+        box = (max(0, self.dirty[0]), max(0, self.dirty[1]),
+               min(size[0], self.dirty[2]), min(size[1], self.dirty[3]))
+        self.dirty = None
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return self.image, False
+        out = layers[0].crop(box)
+        for layer in layers[1:]:
+            out = Image.alpha_composite(out, layer.crop(box))
+        # paste into rotated image, box (x0, y0, x1, y1) maps to
+        # (w-x1, h-y1, w-x0, h-y0) when rotated 180 degrees
+        self.image.paste(out.rotate(180, expand=False), (size[0] - box[2], size[1] - box[3]))
+        self.partial += 1
+        return self.image, True
+
+class map_writer():
+    '''
+    Background map file writer
+    Only the latest pending image for each file is kept, superseded images
+    are dropped, and each file is written at most max_fps times a second.
+    save is the function that writes the file, called as
+    save(image, name, final_name) from the writer thread.
+    '''
+    def __init__(self, save, max_fps=1.0, log=None):
+        if log:
+            self.log = log
+        else:
+            self.log = logging.getLogger("Roomba.{}".format(__name__))
+        self.save = save
+        self.max_fps = max_fps
+        self.pending = OrderedDict()    #file: (image, name, final_name)
+        self.last_write = {}            #file: time last written
+        self.written = 0                #number of images written
+        self.dropped = 0                #number of superseded images dropped
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    @property
+    def interval(self):
+        return 1 / self.max_fps if self.max_fps else 0
+
+    def put(self, image, name, final_name=None):
+        '''
+        queue image to be saved as name (renamed to final_name after writing)
+        NOTE: image must not be changed after it is queued
+        '''
+        key = final_name if final_name else name
+        with self.cond:
+            if self.pending.pop(key, None) is not None:
+                self.dropped += 1
+            self.pending[key] = (image, name, final_name)
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name='map_writer', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def next_image(self):
+        '''
+        wait for the next image that is due to be written, returns None when
+        stopped and nothing is pending
+        '''
+        with self.cond:
+            while True:
+                if not self.pending and not self.running:
+                    return None
+                now = time.monotonic()
+                wait = None
+                for key in self.pending:
+                    remaining = self.last_write.get(key, 0) + self.interval - now
+                    if remaining <= 0 or not self.running:
+                        self.last_write[key] = now
+                        return self.pending.pop(key)
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.cond.wait(wait)
+
+    def run(self):
+        while True:
+            item = self.next_image()
+            if item is None:
+                break
+            try:
+                self.save(*item)
+                self.written += 1
+            except Exception as e:
+                self.log.error('MAP: error writing {}: {}'.format(item[2] if item[2] else item[1], e))
+
+    def stop(self, timeout=10):
+        '''
+        write any pending images, and stop the writer thread
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.log.info('MAP: writer stopped: {}'.format(self.stats()))
+
+    def stats(self):
+        return {'written'   : self.written,
+                'dropped'   : self.dropped,
+                'pending'   : len(self.pending),
+                'max_fps'   : self.max_fps}
+
+class image_cache():
+    '''
+    In memory cache of the most recently encoded bytes of each map image,
+    with a version number and ETag, so the web server does not have to
+    re-encode (or read from disk) images that have not changed.
+    Thread safe, images are added by the map writer thread.
+    '''
+    class entry():
+        def __init__(self, data, version, content_type='image/png', source=None):
+            self.data = data
+            self.version = version
+            self.content_type = content_type
+            self.source = source    #image data was encoded from
+            self.etag = '"{}"'.format(hashlib.blake2b(data, digest_size=8).hexdigest())
+            self._b64 = None
+
+        @property
+        def b64(self):
+            '''
+            base64 encoded data (encoded once, when first used)
+            '''
+            if self._b64 is None:
+                self._b64 = base64.b64encode(self.data)
+            return self._b64
+
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.encodes = 0
+
+    def put(self, name, data, content_type='image/png', source=None):
+        '''
+        store encoded data as name, returns the new cache entry
+        '''
+        with self.lock:
+            old = self.cache.get(name)
+            entry = self.entry(data, old.version + 1 if old else 1, content_type, source)
+            self.cache[name] = entry
+        return entry
+
+    def get(self, name, image=None, encode=None):
+        '''
+        return cache entry for name (or None). If encode is given, and image
+        is not the image the cached data was encoded from, encode(image) is
+        stored and returned.
+        '''
+        with self.lock:
+            entry = self.cache.get(name)
+        if encode is None or (entry is not None and entry.source is image):
+            self.hits += 1
+            return entry
+        self.encodes += 1
+        return self.put(name, encode(image), source=image)
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(name, None)
+
+    def stats(self):
+        return {'images'    : {name: entry.version for name, entry in self.cache.items()},
+                'hits'      : self.hits,
+                'encodes'   : self.encodes}
+
+class timed_queue():
+    '''
+    asyncio.Queue of (put time, item), that measures how long items wait in
+    the queue (latency), and counts the items not marked done yet
+    '''
+    def __init__(self, maxsize=0):
+        self.queue = asyncio.Queue(maxsize)
+        self.unfinished = 0 #items put in the queue, not marked done
+        self.count = 0      #items got from queue
+        self.total = 0      #total latency (s)
+        self.max = 0        #max latency (s)
+        self.last = 0       #latency of last item (s)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def full(self):
+        return self.queue.full()
+
+    def put_nowait(self, item):
+        self.queue.put_nowait((time.monotonic(), item))
+        self.unfinished += 1
+
+    async def put(self, item):
+        await self.queue.put((time.monotonic(), item))
+        self.unfinished += 1
+
+    def get_nowait(self):
+        return self.taken(*self.queue.get_nowait())
+
+    async def get(self):
+        return self.taken(*await self.queue.get())
+
+    def taken(self, put_time, item):
+        '''
+        item has been taken from the queue, return item
+        '''
+        self.last = time.monotonic() - put_time
+        self.count += 1
+        self.total += self.last
+        self.max = max(self.max, self.last)
+        return item
+
+    def task_done(self):
+        self.queue.task_done()
+        self.unfinished -= 1
+
+    async def join(self):
+        await self.queue.join()
+
+    def stats(self):
+        return {'pending'   : self.qsize(),
+                'count'     : self.count,
+                'avg_ms'    : round(1000 * self.total / self.count, 3) if self.count else 0,
+                'max_ms'    : round(1000 * self.max, 3),
+                'last_ms'   : round(1000 * self.last, 3)}
+
+class named_executor(ThreadPoolExecutor):
+    '''
+    ThreadPoolExecutor that counts queued (waiting for a thread) and active
+    jobs, and how long jobs wait to start
+    '''
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.workers = max_workers
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.wait_total = 0             #total wait before starting (s)
+        self.wait_max = 0               #max wait before starting (s)
+        
+    def submit(self, fn, *args, **kwargs):
+        with self.stats_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        try:
+            return super().submit(self.run, time.monotonic(), fn, *args, **kwargs)
+        except Exception:
+            with self.stats_lock:
+                self.queued -= 1
+            raise
+        
+    def run(self, submitted, fn, *args, **kwargs):
+        wait = time.monotonic() - submitted
+        with self.stats_lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.stats_lock:
+                self.active -= 1
+                self.completed += 1
+                
+    def stats(self):
+        with self.stats_lock:
+            started = self.completed + self.active
+            return {'workers'       : self.workers,
+                    'queued'        : self.queued,
+                    'active'        : self.active,
+                    'completed'     : self.completed,
+                    'max_queued'    : self.max_queued,
+                    'wait_avg_ms'   : round(1000 * self.wait_total / started, 3) if started else 0,
+                    'wait_max_ms'   : round(1000 * self.wait_max, 3)}
+
+def in_loop(loop):
+    '''
+    True if called from the thread running loop
+    '''
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+        
+class asyncio_mqtt():
+    '''
+    Runs a paho mqtt client on the asyncio loop, instead of in the network
+    thread started by loop_start(). paho's external socket api is used, the
+    socket is watched with loop.add_reader()/add_writer() and loop_misc()
+    (keepalive) is called every second from a task.
+    Has the same loop_start()/loop_stop() methods as the paho client.
+    '''
+    def __init__(self, client, loop, on_lost=None):
+        self.client = client
+        self.loop = loop
+        self.on_lost = on_lost          #called (in loop) if the connection is lost
+        self.sock = None
+        self.misc = None                #loop_misc task
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        
+    def call(self, func, *args):
+        '''
+        paho calls back from whichever thread is using the client
+        (eg connect() or publish() run in an executor), add_reader() etc.
+        have to be called in the loop
+        '''
+        if in_loop(self.loop):
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+        
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.add_reader, sock)
+        
+    def add_reader(self, sock):
+        self.sock = sock
+        self.loop.add_reader(sock, self.read)
+        
+    def on_socket_close(self, client, userdata, sock):
+        # called before the socket is closed, so remove it now if possible
+        self.call(self.remove, sock)
+        
+    def remove(self, sock):
+        if sock.fileno() != -1:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+        if sock is self.sock:
+            self.sock = None
+        
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.add_writer, sock)
+        
+    def add_writer(self, sock):
+        if sock.fileno() != -1:
+            self.loop.add_writer(sock, self.client.loop_write)
+        
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.remove_writer, sock)
+        
+    def remove_writer(self, sock):
+        if sock.fileno() != -1:
+            self.loop.remove_writer(sock)
+        
+    def read(self):
+        '''
+        read from socket, TLS can buffer data that select() does not see,
+        so keep reading while there is data pending
+        '''
+        sock = self.sock
+        pending = getattr(sock, 'pending', None)    #only ssl sockets buffer
+        rc = self.client.loop_read()
+        while rc == mqtt.MQTT_ERR_SUCCESS and pending and sock is self.sock and pending():
+            rc = self.client.loop_read()
+        
+    async def loop_misc(self):
+        try:
+            while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            return
+        if self.on_lost and self.misc is asyncio.current_task():
+            self.on_lost()
+        
+    def loop_start(self):
+        self.call(self._loop_start)
+        
+    def _loop_start(self):
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.loop_misc())
+        
+    def loop_stop(self):
+        self.call(self._loop_stop)
+        
+    def _loop_stop(self):
+        if self.misc:
+            self.misc.cancel()
+            self.misc = None
+
+class ingest_queue(timed_queue):
+    '''
+    Bounded queue for messages received in the paho (network) thread.
+    Messages are collected by put_threadsafe() and handed off to the event
+    loop in batches, one call_soon_threadsafe per batch (instead of a Future
+    per message). When the queue is full, policy decides what happens:
+        'block'         : the paho thread waits for space in the queue
+                          (messages added in the loop, which can't wait, drop
+                          the oldest message)
+        'drop_oldest'   : the oldest queued message is discarded
+        'coalesce'      : the json payload is merged into the newest queued
+                          message with the same topic, messages with a pose
+                          or mission status are never merged (so no poses or
+                          phase changes are lost), the paho thread waits for
+                          space for them, as for 'block' (else drop oldest)
+    '''
+    policies = ['block', 'drop_oldest', 'coalesce']
+    keep = [b'"pose"', b'"cleanMissionStatus"']    #messages with these keys are not coalesced
+    
+    def __init__(self, loop, size=1000, policy='coalesce', merge=None):
+        super().__init__()
+        self.loop = loop
+        self.size = size                #max messages queued
+        self.policy = policy
+        self.merge = merge              #function to merge json dicts (for coalesce)
+        self.newest = {}                #topic: newest queued message that can be coalesced
+        self.pending = deque()          #messages waiting for handoff to the loop
+        self.scheduled = False          #handoff scheduled in loop
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0                #times the paho thread waited for space
+        self.handoffs = 0               #batches handed off
+        self.handed = 0                 #messages handed off
+        self.handoff_total = 0          #total handoff latency (s)
+        self.handoff_max = 0            #max handoff latency (s)
+        self.depth_max = 0
+        
+    def put_threadsafe(self, item):
+        '''
+        put item in queue from another thread
+        '''
+        with self.lock:
+            if self.policy == 'block' or (self.policy == 'coalesce' and not self.can_coalesce(item)):
+                if len(self.pending) + self.qsize() >= self.size:
+                    self.blocked += 1
+                while len(self.pending) + self.qsize() >= self.size and not self.loop.is_closed():
+                    self.space.wait(1)
+            self.pending.append((time.monotonic(), item))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self._handoff)
+        
+    def _handoff(self):
+        '''
+        move pending messages into the queue (runs in loop)
+        '''
+        with self.lock:
+            batch, self.pending = self.pending, deque()
+            self.scheduled = False
+        now = time.monotonic()
+        for put_time, item in batch:
+            latency = now - put_time
+            self.handoff_total += latency
+            self.handoff_max = max(self.handoff_max, latency)
+            self.add(item)
+        self.handoffs += 1
+        self.handed += len(batch)
+        
+    def add(self, item):
+        '''
+        put item in queue (in the loop), applying the overload policy if the
+        queue is full
+        '''
+        if self.qsize() >= self.size:
+            if self.policy == 'coalesce' and self.coalesce(item):
+                return
+            while self.qsize() >= self.size:
+                self.get_nowait()
+                self.task_done()
+                self.dropped += 1
+                self.count -= 1         #not processed, so not in the latency stats
+                self.total -= self.last
+        self.put_nowait(item)
+        if self.mergeable(item):
+            self.newest[item.topic] = item
+        self.depth_max = max(self.depth_max, self.qsize())
+        
+    def mergeable(self, item):
+        '''
+        True if item can be merged with other messages (no pose or mission
+        status)
+        '''
+        payload = item.payload if isinstance(item.payload, bytes) else str(item.payload).encode()
+        return not any(key in payload for key in self.keep)
+        
+    def can_coalesce(self, item):
+        return self.merge is not None and item.topic in self.newest and self.mergeable(item)
+        
+    def coalesce(self, item):
+        '''
+        merge item payload into the newest queued message with the same topic
+        (if neither has a pose or mission status), return True if merged
+        '''
+        queued = self.newest.get(item.topic)
+        if self.merge is None or queued is None or not self.mergeable(item):
+            return False
+        try:
+            payload = json.loads(queued.payload)
+            new_payload = json.loads(item.payload)
+            if not (isinstance(payload, dict) and isinstance(new_payload, dict)):
+                return False
+            self.merge(payload, new_payload)
+            queued.payload = json.dumps(payload).encode('utf-8')
+        except Exception:
+            return False
+        self.coalesced += 1
+        return True
+        
+    def taken(self, put_time, item):
+        item = super().taken(put_time, item)
+        if self.newest.get(item.topic) is item:
+            del self.newest[item.topic]
+        if self.policy != 'drop_oldest':
+            with self.lock:
+                self.space.notify()
+        return item
+        
+    def stats(self):
+        stats = super().stats()
+        stats.update({'size'            : self.size,
+                      'policy'          : self.policy,
+                      'depth_max'       : self.depth_max,
+                      'dropped'         : self.dropped,
+                      'coalesced'       : self.coalesced,
+                      'blocked'         : self.blocked,
+                      'handoffs'        : self.handoffs,
+                      'handoff_avg_ms'  : round(1000 * self.handoff_total / self.handed, 3) if self.handed else 0,
+                      'handoff_max_ms'  : round(1000 * self.handoff_max, 3)})
+        return stats
+        
+class payload_log():
+    '''
+    log string for a decoded payload, the json is only formatted if the log
+    record is emitted (json_data is None for raw payloads)
+    '''
+    
+    __slots__ = ('payload', 'json_data', 'indent')
+    
+    def __init__(self, payload, json_data=None, indent=0):
+        self.payload = payload
+        self.json_data = json_data
+        self.indent = indent                #number of spaces to indent json data
+        
+    def __str__(self):
+        if self.json_data is None:
+            return str(self.payload)
+        return "Decoded JSON: \n%s" % "\n".join((self.indent * " ") + i for i in \
+            (json.dumps(self.json_data, indent = 2)).splitlines())
+        
+def list_to_str(value):
+    '''
+    string of list value to publish, dicts in the list become (key, value)
+    tuples, other items become strings
+    '''
+    items = []
+    for i in value:
+        if isinstance(i, dict):
+            items.extend((str(k), v) for k, v in i.items())
+        else:
+            items.append(i if isinstance(i, str) else str(i))
+    return str(items)
+
+class topic_map():
+    '''
+    Maps json key paths to broker topics ('feedback/key_subkey'), topic names
+    are cached, so publishing a value only needs one dict lookup per key.
+    '''
+    max_size = 10000    #clear cache if it gets this big
+
+    def __init__(self, feedback=''):
+        self.feedback = feedback
+        self.cache = {}     #(prefix, key): (name, topic)
+
+    def items(self, state, prefix=None, items=None):
+        '''
+        return list of (topic, message) for every value in json dict state
+        '''
+        if items is None:
+            items = []
+        cache = self.cache
+        for k, v in state.items():
+            try:
+                name, topic = cache[prefix, k]
+            except KeyError:
+                if len(cache) >= self.max_size:
+                    cache.clear()
+                name = k if prefix is None else prefix + "_" + k
+                # all data starts with this, so it's redundant
+                topic = '{}/{}'.format(self.feedback, name.replace("state_reported_",""))
+                cache[prefix, k] = name, topic
+            if isinstance(v, dict):
+                self.items(v, name, items)
+            elif isinstance(v, list):
+                items.append((topic, list_to_str(v)))
+            else:
+                items.append((topic, str(v)))
+        return items
+
+class state_index():
+    '''
+    key -> paths index of a nested state dict (master_state), so values can
+    be looked up without walking the whole dict. The paths of each key are
+    in the order recursive_lookup() finds them, and 'cap' sub dicts are not
+    indexed.
+    The index is updated as keys are merged (see changed()), when the order
+    of paths can't be kept (an indexed key is added in a new place, or keys
+    are removed) it is rebuilt on the next lookup.
+    '''
+    def __init__(self, state):
+        self.state = state
+        self.paths = None   #key: [path, ...], None if needs rebuilding
+        self.rebuilds = 0
+
+    def invalidate(self):
+        self.paths = None
 
+    def rebuild(self):
+        self.paths = {}
+        self.index(self.state)
+        self.rebuilds += 1
+
+    def index(self, search_dict, path=()):
+        for k, v in search_dict.items():
+            self.paths.setdefault(k, []).append(path + (k,))
+            if isinstance(v, dict) and k != 'cap':
+                self.index(v, path + (k,))
+
+    def add(self, path, value):
+        '''
+        index a new key at path (and it's sub keys)
+        '''
+        key = path[-1]
+        if key in self.paths:
+            # don't know where this goes in the lookup order
+            self.paths = None
+            return
+        self.paths[key] = [path]
+        if isinstance(value, dict) and key != 'cap':
+            self.add_keys(path, value)
+
+    def add_keys(self, path, value):
+        for k, v in value.items():
+            if self.paths is None:
+                return
+            self.add(path + (k,), v)
+
+    def changed(self, path, old, new, existed):
+        '''
+        update index for key at path (in state), which is about to be set to
+        new. old is the current value (if the key existed).
+        '''
+        if self.paths is None:
+            return
+        if not existed:
+            self.add(path, new)
+        elif path[-1] == 'cap':
+            return
+        elif isinstance(old, dict) and old:
+            # sub keys are removed
+            self.paths = None
+        elif isinstance(new, dict):
+            self.add_keys(path, new)
+
+    def lookup(self, key):
+        '''
+        return value of key, same result as Roomba.recursive_lookup(state, key)
+        ie the first value that is not None (unless key is a top level key).
+        If a key is None, the rest of the dict it is in is not searched.
+        '''
+        if self.paths is None:
+            self.rebuild()
+        skip = None
+        try:
+            for path in self.paths.get(key, []):
+                if skip is not None and path[:len(skip)] == skip:
+                    continue
+                value = self.state
+                for k in path:
+                    value = value[k]
+                if value is not None or len(path) == 1:
+                    return value
+                skip = path[:-1]
+        except (KeyError, TypeError):
+            # state was changed without updating the index
+            self.rebuild()
+            return self.lookup(key)
+        return None
+
+class state_snapshot():
+    '''
+    Derived properties of master_state after each message (or batch of
+    messages) is merged, shared by the state machine, the map renderer and the
+    callback (if set_callback(cb, snapshot=True)). Properties that are not
+    needed for every message are looked up the first time they are used, and
+    then memoized until the next message.
+    '''
+    
+    properties = ('pose', 'co_ords', 'mission', 'phase', 'batPct', 'mssnM',
+                  'rechrgM', 'expireM', 'bin_full', 'tanklvl', 'sku',
+                  'error_num', 'error_message')
+    __slots__ = ('roomba', 'time') + properties
+    
+    def __init__(self, roomba):
+        self.roomba = roomba
+        self.time = time.time()
+        # used for every message
+        self.pose = roomba.pose
+        self.mission = roomba.mission
+        self.phase = roomba.phase
+        self.error_num = roomba.error_num
+        self.error_message = roomba.get_error_message(self.error_num)
+        
+    def __getattr__(self, name):
+        '''
+        only called for properties that have not been looked up yet
+        '''
+        if name not in self.properties:
+            raise AttributeError(name)
+        if name == 'co_ords':
+            value = self.roomba.pose_co_ords(self.pose)
+        elif name == 'error_message':
+            value = self.roomba.get_error_message(self.error_num)
+        else:
+            value = getattr(self.roomba, name)
+        setattr(self, name, value)
+        return value
+        
+    def refresh(self, *names):
+        '''
+        look up properties again next time they are used (eg flags changed)
+        '''
+        for name in names or self.properties:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                pass
+        
+    def frozen(self):
+        '''
+        copy of the snapshot with all properties looked up now, so it doesn't
+        change later (the callback can keep it)
+        '''
+        copy = state_snapshot.__new__(state_snapshot)
+        copy.roomba = self.roomba
+        copy.time = self.time
+        for name in self.properties:
+            setattr(copy, name, getattr(self, name))
+        return copy
+        
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.properties}
+        
+    def __repr__(self):
+        return 'state_snapshot({})'.format(self.as_dict())
 
 class Roomba(object):
     '''
@@ -287,6 +1297,14 @@ class Roomba(object):
     '''
 
     VERSION = __version__ = "2.0i"
+    
+    # executors shared by all Roombas, so that control (commands) never waits
+    # for rendering etc.
+    executors = {}
+    executor_workers = {'render'    : 2,    #map drawing
+                        'io'        : 4,    #publishing, files, setup
+                        'control'   : 2,    #commands, settings
+                        'connect'   : 4}    #(re)connects
 
     states = {"charge"          : "Charging",
               "new"             : "New Mission",
@@ -406,6 +1424,7 @@ class Roomba(object):
             self.log = logging.getLogger("Roomba.{}".format(roombaName if roombaName else __name__))
         if self.log.getEffectiveLevel() == logging.DEBUG:
             self.debug = True
+        self.trace = logging.getLogger("{}.trace".format(self.log.name))  #per message telemetry log
         self.address = address
         # set the following to True to enable pretty printing of json data
         self.pretty_print = False
@@ -421,11 +1440,33 @@ class Roomba(object):
         self.args = None    #shadow class variable
         self.mqttc = None
         self.local_mqtt = False
+        self.asyncio_mqtt = False           #run mqtt clients on the asyncio loop, not in paho threads
+        self.network = None                 #runs client network loop (client or asyncio_mqtt)
+        self.broker_network = None          #runs mqttc network loop
+        self.reconnecting = None            #reconnect task
+        self.supervising = False            #async_connect() is running
+        self.reconnect_min = 1              #first retry delay (s)
+        self.reconnect_max = 120            #max retry delay (s)
+        self.connect_timeout = 10           #time (s) to wait for on_connect
+        self.health = 'disconnected'        #disconnected, connecting, connected or backoff
+        self.health_changed = None          #time health last changed
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.disconnects = 0                #unexpected disconnects
+        self.connect_latency = 0            #time (s) taken to connect (last connect)
+        self.connect_latency_max = 0
         self.exclude = ""
         self.roomba_connected = False
         self.indent = 0
         self.master_indent = 0
         self.raw = False
+        self.publish_unchanged = False      #publish all values, not just changes
+        self.suppressed_publishes = 0       #unchanged values not published
+        self.topic_map = topic_map()        #json key to broker topic names
+        self.max_batch = 100                #max queued messages to process at once
+        self.intermediate_poses = []        #poses received since the map was last drawn
         self.drawmap = False
         self.mapSize = None
         self.roomba_angle = 0
@@ -440,12 +1481,26 @@ class Roomba(object):
         self.max_distance = 500             #max distance to draw lines
         self.icons = icons(base_icon=None, angle=self.angle, fnt=self.fnt, size=(32,32), log=self.log)
         self.base = None                    #base map
+        self.map_compositor = map_compositor(log=self.log)
+        self.map_writer = None              #background map writer
+        self.map_process = None             #worker process for encoding/contours
+        self.recorder = None                #mission_recorder of current mission
+        self.record_path = None             #path to record missions to (None is off)
+        self.record_chunk = 256             #rows per recorded chunk
+        self.recorded_keys = {'pose', 'cleanMissionStatus', 'batPct', 'bbrun'}  #message keys that are recorded
+        self.record_jobs = set()            #pending recorder flush/close futures
+        self.image_cache = image_cache()    #encoded map images
+        self.map_output = {}                #live map encoder options
+        self.map_ext = 'png'                #live map file type
+        self.roomba_sprite = None           #roomba and dock overlay
+        self.sprite_box = None              #last position of roomba icon on map
         self.room_outline_contour = None
         self.room_outline = None
         self.floorplan = None
         self.floorplan_size = None
         self.previous_display_text = self.display_text = None
         self.master_state = {}
+        self.state_index = state_index(self.master_state)
         self.update_seconds = 300           #update with all values every 5 minutes
         self.show_final_map = True
         self.client = None                  #Roomba MQTT client
@@ -455,10 +1510,13 @@ class Roomba(object):
         self.flags = {}
         self.max_sqft = None
         self.cb = None
+        self.cb_snapshot = False            #pass state_snapshot to cb
+        self.snapshot = None                #state_snapshot of last message
+        self.subscribers = set()            #queues of decoded messages (eg web server streams)
         
         self.is_connected = asyncio.Event()
-        self.q = asyncio.Queue()
-        self.command_q = asyncio.Queue()            
+        self.q = ingest_queue(self.loop, merge=self.merge_delta)
+        self.command_q = timed_queue()
         self.loop.create_task(self.process_q())
         self.loop.create_task(self.process_command_q())
         self.update = self.loop.create_task(self.periodic_update())
@@ -520,6 +1578,10 @@ class Roomba(object):
             self.client.on_publish = self.on_publish
             self.client.on_subscribe = self.on_subscribe
             self.client.on_disconnect = self.on_disconnect
+            if self.asyncio_mqtt:
+                self.network = asyncio_mqtt(self.client, self.loop)
+            else:
+                self.network = self.client
 
             # Uncomment to enable debug messages
             #self.client.on_log = self.on_log
@@ -554,54 +1616,146 @@ class Roomba(object):
     async def async_connect(self):
         '''
         Connect to Roomba MQTT server
+        Reconnect supervisor, runs until connected (or cancelled). Failed
+        attempts are retried with exponential backoff and jitter (so that many
+        Roombas don't all reconnect at the same time, eg after a network
+        restart), up to reconnect_max seconds apart.
         '''
         if not all([self.address, self.blid, self.password]):
             self.log.critical("Invalid address, blid, or password! All these "
                               "must be specified!")
             return False
-        count = 0
-        max_retries = 3
-        retry_timeout = 1
-        while not self.roomba_connected:
-            try:
-                if self.client is None:
-                    self.log.info("Connecting...")
-                    self.setup_client()
-                    await self.loop.run_in_executor(None, self.client.connect, self.address, self.roomba_port, 60)
-                else:
-                    self.log.info("Attempting to Reconnect...")
-                    self.client.loop_stop()
-                    await self.loop.run_in_executor(None, self.client.reconnect)
-                self.client.loop_start()
-                await self.event_wait(self.is_connected, 1)    #wait for MQTT on_connect to fire (timeout 1 second)
-            except (ConnectionRefusedError, OSError) as e:
-                if e.errno == 111:      #errno.ECONNREFUSED
-                    self.log.error('Unable to Connect to roomba {}, make sure nothing else is connected (app?), '
-                                   'as only one connection at a time is allowed'.format(self.roombaName))
-                elif e.errno == 113:    #errno.No Route to Host
-                    self.log.error('Unable to contact roomba {} on ip {}'.format(self.roombaName, self.address))
-                else:
-                    self.log.error("Connection Error: {} ".format(e))
-                
-                await asyncio.sleep(retry_timeout)
-                self.log.error("Attempting retry Connection# {}".format(count))
-                
-                count += 1
-                if count >= max_retries:
-                    retry_timeout = 60
+        if self.supervising:
+            self.log.debug('Connection already in progress')
+            return self.roomba_connected
+        self.supervising = True
+        attempt = 0
+        try:
+            while not self.roomba_connected:
+                try:
+                    if attempt == 0 and self.client is not None:
+                        #spread out reconnects
+                        await asyncio.sleep(random.uniform(0, self.reconnect_min))
+                    self.set_health('connecting')
+                    self.connect_attempts += 1
+                    start = time.monotonic()
+                    self.is_connected.clear()
+                    if self.client is None:
+                        self.log.info("Connecting...")
+                        self.setup_client()
+                        await self.loop.run_in_executor(self.get_executor('connect'), self.client.connect, self.address, self.roomba_port, 60)
+                    else:
+                        self.log.info("Attempting to Reconnect...")
+                        await self.loop.run_in_executor(self.get_executor('connect'), self.network.loop_stop)
+                        await self.loop.run_in_executor(self.get_executor('connect'), self.client.reconnect)
+                    self.network.loop_start()
+                    #wait for MQTT on_connect to fire
+                    if await self.event_wait(self.is_connected, self.connect_timeout) and self.roomba_connected:
+                        self.connected_time(time.monotonic() - start)
+                        break
+                    self.log.error('No connection to {} after {}s'.format(self.roombaName, self.connect_timeout))
+                except (ConnectionRefusedError, OSError) as e:
+                    if e.errno == 111:      #errno.ECONNREFUSED
+                        self.log.error('Unable to Connect to roomba {}, make sure nothing else is connected (app?), '
+                                       'as only one connection at a time is allowed'.format(self.roombaName))
+                    elif e.errno == 113:    #errno.No Route to Host
+                        self.log.error('Unable to contact roomba {} on ip {}'.format(self.roombaName, self.address))
+                    else:
+                        self.log.error("Connection Error: {} ".format(e))
+                except asyncio.CancelledError:
+                    self.log.error('Connection Cancelled')
+                    break
+                except Exception as e:
+                    #self.log.error("Error: {} ".format(e))
+                    self.log.exception(e)
                     
-            except asyncio.CancelledError:
-                self.log.error('Connection Cancelled')
-                break
-            except Exception as e:
-                #self.log.error("Error: {} ".format(e))
-                self.log.exception(e)
-                if count >= max_retries:
+                self.connect_failures += 1
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.set_health('backoff')
+                self.log.error("Attempting retry Connection# {} in {:.1f}s".format(attempt, delay))
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self.log.error('Connection Cancelled')
                     break
+        finally:
+            self.supervising = False
             
-        if not self.roomba_connected:   
+        if not self.roomba_connected:
+            self.set_health('disconnected')
             self.log.error("Unable to connect to {}".format(self.roombaName))
         return self.roomba_connected
+        
+    def backoff(self, attempt):
+        '''
+        delay (s) before retry number attempt (starting at 0), doubles each
+        attempt up to reconnect_max, randomized by up to half to spread out
+        reconnects
+        '''
+        delay = min(self.reconnect_max, self.reconnect_min * 2 ** min(attempt, 32))
+        return delay / 2 + random.uniform(0, delay / 2)
+        
+    @classmethod
+    def set_executors(cls, **workers):
+        '''
+        set number of threads for executors, eg set_executors(render=1, io=2)
+        call before connecting, executors that already exist are not changed
+        '''
+        for name, max_workers in workers.items():
+            if name not in cls.executor_workers:
+                raise ValueError('Unknown executor: {}, choose from: {}'.format(name, list(cls.executor_workers.keys())))
+            cls.executor_workers[name] = max(1, int(max_workers))
+        
+    @classmethod
+    def get_executor(cls, name):
+        '''
+        executor by name (render, io, control or connect), shared by all
+        Roombas in this process
+        '''
+        executor = cls.executors.get(name)
+        if executor is None:
+            executor = cls.executors[name] = named_executor(name, cls.executor_workers[name])
+        return executor
+        
+    @classmethod
+    def executor_stats(cls):
+        '''
+        return queue depth etc. of the executors in use
+        '''
+        return {name: executor.stats() for name, executor in cls.executors.items()}
+        
+    def set_health(self, health):
+        if health != self.health:
+            self.log.debug('Connection health: {} -> {}'.format(self.health, health))
+            self.health = health
+            self.health_changed = time.time()
+        
+    def connected_time(self, latency):
+        '''
+        record successful connection, and how long it took (s)
+        '''
+        self.set_health('connected')
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self.connect_latency = latency
+        self.connect_latency_max = max(self.connect_latency_max, latency)
+        self.log.info('Connected to {} in {:.3f}s'.format(self.roombaName, latency))
+        
+    def connection_stats(self):
+        '''
+        return connection health and metrics
+        '''
+        return {'health'            : self.health,
+                'since'             : time.ctime(self.health_changed) if self.health_changed else None,
+                'connects'          : self.connects,
+                'reconnects'        : self.reconnects,
+                'attempts'          : self.connect_attempts,
+                'failures'          : self.connect_failures,
+                'disconnects'       : self.disconnects,
+                'last_connect_ms'   : round(1000 * self.connect_latency, 1),
+                'max_connect_ms'    : round(1000 * self.connect_latency_max, 1)}
 
     def disconnect(self):
         try:
@@ -617,8 +1771,17 @@ class Roomba(object):
         self.log.info("Cancelling {} outstanding tasks".format(len(tasks)))
         await asyncio.gather(*tasks, return_exceptions=True)
         self.client.disconnect()
+        if self.map_writer:
+            await self.loop.run_in_executor(self.get_executor('io'), self.map_writer.stop)
+        if self.map_process:
+            await self.loop.run_in_executor(self.get_executor('io'), self.map_process.stop)
+        if self.recorder:
+            self.record_job(self.recorder.close)
+            self.recorder = None
+        if self.record_jobs:
+            await asyncio.wait(self.record_jobs)
         if self.local_mqtt:
-            self.mqttc.loop_stop()
+            self.broker_network.loop_stop()
         self.log.info('{} disconnected'.format(self.roombaName))
         
     def connected(self, state):
@@ -647,42 +1810,139 @@ class Roomba(object):
         if self.indent == 0:
             self.master_indent = max(self.master_indent, len(msg.topic))
             
-        if not self.simulation:
-            asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
+        if self.simulation:
+            return
+        if self.asyncio_mqtt:
+            self.q.add(msg)
+        else:
+            self.q.put_threadsafe(msg)
             
     async def process_q(self):
         '''
         Main processing loop, run until program exit
+        Messages waiting in the queue are processed as a batch, they are
+        merged in order, then the changes are published, and the state
+        machine (and map) updated once for the batch. Messages that change
+        the mission phase or cycle are always processed on their own.
         '''
+        next_msg = None
         while True:
             try:
-                if self.q.qsize() > 0:
-                    self.log.warning('Pending event queue size is: {}'.format(self.q.qsize()))
-                msg = await self.q.get()
+                if next_msg is None:
+                    next_msg = self.decode_message(await self.q.get())
                 
                 if not self.command_q.empty():
-                    self.log.info('Command waiting in queue')
-                    await asyncio.sleep(1)
+                    # commands go first, let process_command_q() take them
+                    # (and start sending them) before this batch, but don't
+                    # wait for them to be sent
+                    self.trace.info('Command waiting in queue')
+                    await asyncio.sleep(0)
                     
-                log_string, json_data = self.decode_payload(msg.topic,msg.payload)
-                self.dict_merge(self.master_state, json_data)
-
-                if self.pretty_print:
-                    self.log.info("%-{:d}s : %s".format(self.master_indent) % (msg.topic, log_string))
-                else:
-                    self.log.info("Received Roomba Data: {}, {}".format(str(msg.topic), str(msg.payload)))
-
-                if self.raw:
-                    self.publish(msg.topic, msg.payload)
-                else:
-                    await self.loop.run_in_executor(None, self.decode_topics, json_data)
+                if self.q.qsize() > self.max_batch:
+                    self.log.warning('Pending event queue size is: {}'.format(self.q.qsize()))
                     
-                self.q.task_done()
+                batch = {}      #all values received
+                delta = {}      #values that changed
+                values = 0      #number of values received
+                poses = []      #pose after each message with a new pose
+                count = 0
+                try:
+                    while True:
+                        msg, log_string, json_data = next_msg
+                        next_msg = None
+                        count += 1
+                        mission_changed = self.changes_mission(json_data)
+                        msg_delta = self.dict_merge(self.master_state, json_data)
+                        if self.record_path is not None:
+                            self.record_mission(json_data)
+
+                        if self.pretty_print:
+                            self.trace.info("%-*s : %s", self.master_indent, msg.topic, log_string)
+                        else:
+                            self.trace.info("Received Roomba Data: %s, %s", msg.topic, msg.payload)
+
+                        if self.raw:
+                            self.publish(msg.topic, msg.payload)
+                        else:
+                            values += self.count_leaves(json_data)
+                            if self.publish_unchanged:
+                                self.merge_delta(batch, json_data)
+                        self.merge_delta(delta, msg_delta)
+                        if 'pose' in msg_delta.get('state', {}).get('reported', {}):
+                            poses.append(self.co_ords)
+                        
+                        if mission_changed or count >= self.max_batch or self.q.empty():
+                            break
+                        next_msg = self.decode_message(self.q.get_nowait())
+                        if self.changes_mission(next_msg[2]):
+                            # process on it's own, in the next batch
+                            break
+                            
+                    if count > 1:
+                        self.trace.info('Processed %d queued messages as one batch', count)
+
+                    if not self.raw:
+                        # only publish values that have changed (unless publish_unchanged)
+                        publish = batch if self.publish_unchanged else delta
+                        self.suppressed_publishes += values - self.count_leaves(publish)
+                        # draw map lines through the poses before the current one
+                        # (kept until the map is drawn, see render_map())
+                        if self.drawmap:
+                            self.intermediate_poses += poses
+                        flags = dict(self.master_state['state'].get('flags', {}))
+                        await self.loop.run_in_executor(self.get_executor('render'), self.decode_topics, publish)
+                        if flags != self.master_state['state'].get('flags', {}):
+                            # flags are derived by the state machine, not in the message
+                            delta.setdefault('state', {})['flags'] = dict(self.master_state['state']['flags'])
+                        
+                    if delta:
+                        self.notify_subscribers(delta)
+                finally:
+                    for i in range(count):
+                        self.q.task_done()
                 
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.exception(e)
+                
+    def decode_message(self, msg):
+        '''
+        return msg, log string and json dict of msg payload (msg is marked
+        done in the queue if it can't be decoded)
+        '''
+        try:
+            log_string, json_data = self.decode_payload(msg.topic,msg.payload)
+        except Exception:
+            self.q.task_done()
+            raise
+        return msg, log_string, json_data
+        
+    def changes_mission(self, json_data):
+        '''
+        True if merging json_data would change the mission phase or cycle
+        '''
+        try:
+            status = json_data['state']['reported']['cleanMissionStatus']
+        except (KeyError, TypeError):
+            return False
+        current = self.cleanMissionStatus
+        if not isinstance(current, dict):
+            current = {}
+        return any(key in status and status[key] != current.get(key) for key in ['phase', 'cycle'])
+        
+    def merge_delta(self, batch, delta):
+        '''
+        merge delta into batch, dicts are copied so batch does not share
+        dicts with master_state
+        '''
+        for k, v in delta.items():
+            if isinstance(v, dict):
+                if not isinstance(batch.get(k), dict):
+                    batch[k] = {}
+                self.merge_delta(batch[k], v)
+            else:
+                batch[k] = v
 
     async def periodic_update(self):
         '''
@@ -692,8 +1952,11 @@ class Roomba(object):
             # default every 5 minutes
             await asyncio.sleep(self.update_seconds)
             if self.roomba_connected:
-                self.log.info("Publishing master_state")
-                await self.loop.run_in_executor(None, self.decode_topics, self.master_state)
+                self.log.info("Publishing master_state ({} unchanged values not published)".format(self.suppressed_publishes))
+                self.log.info("Queue stats: {}".format(self.queue_stats()))
+                self.log.info("Connection stats: {}".format(self.connection_stats()))
+                self.log.info("Executor stats: {}".format(self.executor_stats()))
+                await self.loop.run_in_executor(self.get_executor('io'), self.decode_topics, self.master_state)
 
     def on_publish(self, mosq, obj, mid):
         pass
@@ -701,17 +1964,36 @@ class Roomba(object):
     def on_subscribe(self, mosq, obj, mid, granted_qos):
         self.log.debug("Subscribed: {} {}".format(str(mid), str(granted_qos)))
 
+    def connection_lost(self):
+        '''
+        Roomba connection lost, start the reconnect supervisor (which stops
+        paho's own network thread from reconnecting)
+        '''
+        self.disconnects += 1
+        self.set_health('disconnected')
+        if not self.supervising:
+            self.reconnecting = self.connect()
+
     def on_disconnect(self, mosq, obj, rc):
         self.loop.call_soon_threadsafe(self.is_connected.clear)
         self.connected(False)
         if rc != 0:
             self.log.warning("Unexpected Disconnect! - reconnecting")
+            self.loop.call_soon_threadsafe(self.connection_lost)
         else:
             self.log.info("Disconnected")
 
     def on_log(self, mosq, obj, level, string):
         self.log.info(string)
 
+    def set_mqtt_transport(self, use_asyncio=False):
+        '''
+        use_asyncio=True runs the Roomba and local broker mqtt clients on the
+        asyncio loop, instead of in a paho network thread per client.
+        Call before connecting.
+        '''
+        self.asyncio_mqtt = use_asyncio
+        
     def set_mqtt_client(self, mqttc=None, brokerFeedback='/roomba/feedback'):
         self.mqttc = mqttc
         if self.mqttc is not None:
@@ -731,7 +2013,7 @@ class Roomba(object):
                                 brokerSetting='/roomba/setting'):
         #returns an awaitable future
                                 
-        return self.loop.run_in_executor(None, self._setup_mqtt_client, broker,
+        return self.loop.run_in_executor(self.get_executor('io'), self._setup_mqtt_client, broker,
                                                port, user, passwd,
                                                brokerFeedback, brokerCommand,
                                                brokerSetting)
@@ -754,19 +2036,48 @@ class Roomba(object):
             self.mqttc.on_message = self.broker_on_message
             self.mqttc.on_connect = self.broker_on_connect
             self.mqttc.on_disconnect = self.broker_on_disconnect
+            if self.asyncio_mqtt:
+                self.broker_network = asyncio_mqtt(self.mqttc, self.loop, self.broker_connection_lost)
+            else:
+                self.broker_network = self.mqttc
             if user and passwd:
                 self.mqttc.username_pw_set(user, passwd)
             self.mqttc.connect(broker, port, 60)
             self.brokerFeedback = self.set_mqtt_topic(brokerFeedback)
             self.brokerCommand = self.set_mqtt_topic(brokerCommand, True)
             self.brokerSetting = self.set_mqtt_topic(brokerSetting, True)
-            self.mqttc.loop_start()
+            self.broker_network.loop_start()
             self.local_mqtt = True
         except socket.error:
             self.log.error("Unable to connect to MQTT Broker")
             self.mqttc = None
         return self.mqttc
         
+    def broker_connection_lost(self):
+        '''
+        asyncio_mqtt lost the broker connection, reconnect (as paho's network
+        thread would)
+        '''
+        self.loop.create_task(self.broker_reconnect())
+        
+    async def broker_reconnect(self):
+        attempt = 0
+        while True:
+            try:
+                await self.loop.run_in_executor(self.get_executor('connect'), self.mqttc.reconnect)
+                self.broker_network.loop_start()
+                return
+            except asyncio.CancelledError:
+                return
+            except socket.error as e:
+                delay = self.backoff(attempt)
+                attempt += 1
+                self.log.warning('Unable to reconnect to MQTT Broker: {}, retrying in {:.1f}s'.format(e, delay))
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    return
+            
     def broker_on_connect(self, client, userdata, flags, rc):
         self.log.debug("Broker Connected with result code " + str(rc))
         #subscribe to roomba commands and settings messages
@@ -800,7 +2111,10 @@ class Roomba(object):
         elif 'simulate' in msg.topic:
             self.log.info('received simulate command: {}'.format(payload))
             self.set_simulate(True)
-            asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
+            if self.asyncio_mqtt:
+                self.q.add(msg)
+            else:
+                self.q.put_threadsafe(msg)
         else:
             self.log.warn("Unknown topic: {}".format(str(msg.topic)))
             
@@ -839,17 +2153,34 @@ class Roomba(object):
         Command processing loop, run until program exit
         '''
         while True:
-            value = await self.command_q.get()
-            command = value.get('command')
-            setting = value.get('setting')
-            schedule = value.get('schedule')
-            if command:
-                await self.loop.run_in_executor(None, self._send_command, command)
-            if setting:
-                await self.loop.run_in_executor(None, self._set_preference, *setting)
-            if schedule:
-                await self.loop.run_in_executor(None, self._set_cleanSchedule, schedule)
-            self.command_q.task_done()
+            try:
+                value = await self.command_q.get()
+            except asyncio.CancelledError:
+                break
+            try:
+                command = value.get('command')
+                setting = value.get('setting')
+                schedule = value.get('schedule')
+                if command:
+                    await self.loop.run_in_executor(self.get_executor('control'), self._send_command, command)
+                if setting:
+                    await self.loop.run_in_executor(self.get_executor('control'), self._set_preference, *setting)
+                if schedule:
+                    await self.loop.run_in_executor(self.get_executor('control'), self._set_cleanSchedule, schedule)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.log.exception(e)
+            finally:
+                self.command_q.task_done()
+                
+    def queue_stats(self):
+        '''
+        return latency stats (time waiting in queue) for the message (q) and
+        command queues
+        '''
+        return {'q'         : self.q.stats(),
+                'command_q' : self.command_q.stats()}
 
     def _send_command(self, command):
         '''
@@ -957,11 +2288,39 @@ class Roomba(object):
     def publish(self, topic, message):
         if self.mqttc is not None and message is not None:
             topic = '{}/{}'.format(self.brokerFeedback, topic)
-            self.log.debug("Publishing item: {}: {}".format(topic, message))
+            self.trace.debug("Publishing item: %s: %s", topic, message)
             self.mqttc.publish(topic, message)
             
-    def set_callback(self, cb=None):
+    def set_callback(self, cb=None, snapshot=False):
+        '''
+        cb is called with master_state after each message (or batch of
+        messages), if snapshot is True, it is called with
+        (master_state, state_snapshot), where all the snapshot values are
+        looked up before cb is called, and don't change afterwards
+        '''
         self.cb = cb
+        self.cb_snapshot = snapshot
+        
+    def subscribe(self, maxsize=100):
+        '''
+        return an asyncio.Queue that receives the values that changed (json
+        dict) in each message after it has been processed (including the
+        flags, if the state machine changed them). Call
+        unsubscribe(queue) when done. If the queue is full, the oldest
+        message is dropped.
+        '''
+        queue = asyncio.Queue(maxsize)
+        self.subscribers.add(queue)
+        return queue
+        
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        
+    def notify_subscribers(self, json_data):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(json_data)
         
     def get_colour(self, colour, default=(64,64,64,255)):
         try:
@@ -978,16 +2337,41 @@ class Roomba(object):
             colour = default
         return colour
             
-    def set_options(self, raw=False, indent=0, pretty_print=False, max_sqft=0):
+    def set_trace(self, enable=True):
+        '''
+        enable/disable the per message telemetry log (received data, state
+        machine, map drawing and published items), logged to <log name>.trace
+        at the level of the Roomba log. Disabling it also stops replay_log.py
+        from working on the log file.
+        '''
+        self.trace.setLevel(logging.NOTSET if enable else logging.CRITICAL + 1)
+        self.log.info('Telemetry trace log {}'.format('enabled' if enable else 'disabled'))
+
+    def set_options(self, raw=False, indent=0, pretty_print=False, max_sqft=0, publish_unchanged=False):
         self.raw = raw
         self.indent = indent
         self.pretty_print = pretty_print
         self.max_sqft = int(max_sqft)
+        self.publish_unchanged = publish_unchanged
         if self.raw:
             self.log.info("Posting RAW data")
-        else:
+        elif self.publish_unchanged:
             self.log.info("Posting DECODED data")
+        else:
+            self.log.info("Posting DECODED data (changed values only)")
                                         
+    def set_ingest(self, size=1000, policy='coalesce'):
+        '''
+        set max size of the incoming message queue, and what to do when it is
+        full (policy is one of 'block', 'drop_oldest' or 'coalesce')
+        '''
+        if policy not in self.q.policies:
+            self.log.error('Unknown ingest policy: {}, using: {}'.format(policy, self.q.policy))
+            policy = self.q.policy
+        self.q.size = max(1, int(size))
+        self.q.policy = policy
+        self.log.info('Ingest queue size: {}, policy: {}'.format(self.q.size, self.q.policy))
+        
     def enable_map(self, enable=False, mapSize="(800,1500,0,0,0,0)",
                    mapPath=".", iconPath = "./", roomOutline=True,
                    enableMapWithText=True,
@@ -1005,7 +2389,7 @@ class Roomba(object):
                    roomba_size=(50,50), draw_edges = 30, auto_rotate=False):
         #returns an awaitable future
         
-        return self.loop.run_in_executor(None,  self._enable_map, enable,
+        return self.loop.run_in_executor(self.get_executor('render'), self._enable_map, enable,
                                                 mapSize, mapPath, iconPath, roomOutline,
                                                 enableMapWithText, fillColor, outlineColor, outlineWidth,
                                                 home_icon_file, roomba_icon_file, roomba_error_file,
@@ -1143,7 +2527,7 @@ class Roomba(object):
         td = dt - datetime.datetime(1970, 1, 1)
         return int(td.total_seconds())
 
-    def dict_merge(self, dct, merge_dct):
+    def dict_merge(self, dct, merge_dct, path=None):
         '''
         Recursive dict merge. Inspired by :meth:``dict.update()``, instead
         of updating only top-level keys, dict_merge recurses down into dicts
@@ -1151,14 +2535,32 @@ class Roomba(object):
         merged into ``dct``.
         :param dct: dict onto which the merge is executed
         :param merge_dct: dct merged into dct
-        :return: None
+        :param path: keys of dct in master_state, to update the state index
+        :return: dict of the values in merge_dct that changed dct (delta)
         '''
+        if path is None and dct is self.master_state:
+            path = ()
+        delta = {}
         for k, v in merge_dct.items():
             if (k in dct and isinstance(dct[k], dict)
                     and isinstance(merge_dct[k], Mapping)):
-                self.dict_merge(dct[k], merge_dct[k])
+                changed = self.dict_merge(dct[k], merge_dct[k], None if path is None else path + (k,))
+                if changed:
+                    delta[k] = changed
+            elif k in dct and type(dct[k]) is type(v) and dct[k] == v:
+                continue
             else:
+                if path is not None:
+                    self.state_index.changed(path + (k,), dct.get(k), v, k in dct)
                 dct[k] = merge_dct[k]
+                delta[k] = merge_dct[k]
+        return delta
+        
+    def count_leaves(self, state):
+        '''
+        number of values (not dicts) in nested dict state
+        '''
+        return sum(self.count_leaves(v) if isinstance(v, dict) else 1 for v in state.values())
                 
     def recursive_lookup(self, search_dict, key, cap=False):
         '''
@@ -1191,32 +2593,19 @@ class Roomba(object):
 
     def decode_payload(self, topic, payload):
         '''
-        Format json for pretty printing, return string suitable for logging,
-        and a dict of the json data
+        Decode json payload (bytes), return object suitable for logging
+        (formatted when the log record is emitted), and a dict of the json
+        data. Raises ValueError if the payload is not a json dict.
         '''
-        indent = self.master_indent + 31 #number of spaces to indent json data
-
-        try:
-            # if it's json data, decode it (use OrderedDict to preserve keys
-            # order), else return as is...
-            json_data = json.loads(
-                payload.decode("utf-8").replace(":nan", ":NaN").\
-                replace(":inf", ":Infinity").replace(":-inf", ":-Infinity"))  #removed object_pairs_hook=OrderedDict
-            # if it's not a dictionary, probably just a number
-            if not isinstance(json_data, dict):
-                return json_data, dict(json_data)
-            json_data_string = "\n".join((indent * " ") + i for i in \
-                (json.dumps(json_data, indent = 2)).splitlines())
-
-            formatted_data = "Decoded JSON: \n%s" % (json_data_string)
-
-        except ValueError:
-            formatted_data = payload
-
-        if self.raw:
-            formatted_data = payload
-
-        return formatted_data, dict(json_data)
+        # json.loads() accepts NaN and Infinity, but the Roomba sends nan and
+        # inf, only replace them if they are there
+        if b':nan' in payload or b':inf' in payload or b':-inf' in payload:
+            payload = payload.replace(b":nan", b":NaN").replace(b":inf", b":Infinity").replace(b":-inf", b":-Infinity")
+        json_data = json.loads(payload)
+        # if it's not a dictionary, probably just a number
+        if not isinstance(json_data, dict):
+            raise ValueError('payload is not a json object: {}'.format(payload))
+        return payload_log(payload, None if self.raw else json_data, self.master_indent + 31), json_data
 
     def decode_topics(self, state, prefix=None):
         '''
@@ -1225,30 +2614,12 @@ class Roomba(object):
         topic name strings are expressly converted to strings to avoid unicode
         representations
         '''
-        for k, v in state.items():
-            if isinstance(v, dict):
-                if prefix is None:
-                    self.decode_topics(v, k)
-                else:
-                    self.decode_topics(v, prefix+"_"+k)
-            else:
-                if isinstance(v, list):
-                    newlist = []
-                    for i in v:
-                        if isinstance(i, dict):
-                            for ki, vi in i.items():
-                                newlist.append((str(ki), vi))
-                        else:
-                            if not isinstance(i, str):
-                                i = str(i)
-                            newlist.append(i)
-                    v = newlist
-                if prefix is not None:
-                    k = prefix+"_"+k
-                # all data starts with this, so it's redundant
-                k = k.replace("state_reported_","")
-                    
-                self.publish(k, str(v))
+        if self.mqttc is not None:
+            if self.topic_map.feedback != self.brokerFeedback:
+                self.topic_map = topic_map(self.brokerFeedback)
+            for topic, message in self.topic_map.items(state, prefix):
+                self.trace.debug("Publishing item: %s: %s", topic, message)
+                self.mqttc.publish(topic, message)
 
         if prefix is None:
             self.update_state_machine()
@@ -1258,7 +2629,7 @@ class Roomba(object):
         if not isinstance(items, list):
             items = [items]
         for item in items:
-            value = await self.loop.run_in_executor(None, self.get_property, item)
+            value = await self.loop.run_in_executor(self.get_executor('control'), self.get_property, item)
             result[item] = value
         return result
         
@@ -1271,22 +2642,38 @@ class Roomba(object):
             error_message = "Unknown Error number: {}".format(error_num)
         return error_message
         
-    def publish_error_message(self):
-        self.publish("error_message", self.error_message)
+    def publish_error_message(self, error_message=None):
+        self.publish("error_message", error_message if error_message is not None else self.error_message)
             
     def get_property(self, property, cap=False):
         '''
         Only works correctly if property is a unique key
         '''
         if property in ['cleanSchedule', 'langs']:
-            value = self.recursive_lookup(self.master_state, property+'2', cap)
+            value = self.lookup_state(property+'2', cap)
             if value is not None:
                 return value
-        return self.recursive_lookup(self.master_state, property, cap)
+        return self.lookup_state(property, cap)
+        
+    def lookup_state(self, key, cap=False):
+        '''
+        look up key in master_state using the state index, same result as
+        recursive_lookup(self.master_state, key, cap)
+        '''
+        if cap:
+            return self.recursive_lookup(self.master_state, key, cap)
+        if self.state_index.state is not self.master_state:
+            self.state_index = state_index(self.master_state)
+        return self.state_index.lookup(key)
         
     @property    
     def co_ords(self):
-        co_ords = self.pose
+        return self.pose_co_ords(self.pose)
+        
+    def pose_co_ords(self, co_ords):
+        '''
+        map co-ordinates of pose (zero co-ords if there is no pose)
+        '''
         if isinstance(co_ords, dict):
             return {'x': -co_ords['point']['y'] if self.invert_x else co_ords['point']['y'],
                     'y': -co_ords['point']['x'] if self.invert_y else co_ords['point']['x'],
@@ -1401,6 +2788,7 @@ class Roomba(object):
         return False
             
     def handle_flags(self, flags=None, set=False):
+        old_flags = list(self.master_state['state'].get('flags', [None]))
         self.master_state['state'].setdefault('flags', {})
         if isinstance(flags, str):
             flags = [flags]
@@ -1417,6 +2805,11 @@ class Roomba(object):
             self.flags = {}
             if not set:
                 self.master_state['state']['flags'] = self.flags
+        if list(self.master_state['state']['flags']) != old_flags:
+            # flags are looked up as properties (eg bin_full)
+            self.state_index.invalidate()
+            if self.snapshot is not None:
+                self.snapshot.refresh('bin_full')
         
     def update_precent_complete(self):
         try:
@@ -1563,20 +2956,24 @@ class Roomba(object):
         mission goes from 'clean' (or other mission) to 'none' at end of missions (finalize map)
         Anything else = continue with existing map
         '''
+        snapshot = self.snapshot = state_snapshot(self)   #derived properties, looked up once
         if new_state is not None:
             self.current_state = self.states[new_state]
             self.log.info("set current state to: {}".format(self.current_state))
             self.draw_map(True)
             return    
             
-        self.publish_error_message()                #publish error messages
+        self.publish_error_message(snapshot.error_message)  #publish error messages
         self.update_precent_complete()
-        mission = self.update_history("cycle")      #mission
-        phase = self.update_history("phase")        #mission phase
-        self.update_history("pose")                 #update co-ordinates
+        mission = self.update_history("cycle", snapshot.mission)    #mission
+        phase = self.update_history("phase", snapshot.phase)        #mission phase
+        self.update_history("pose", snapshot.pose)                  #update co-ordinates
         
         if self.cb is not None:                     #call callback if set
-            self.cb(self.master_state)
+            if self.cb_snapshot:
+                self.cb(self.master_state, snapshot.frozen())
+            else:
+                self.cb(self.master_state)
         
         if phase is None or mission is None:
             return
@@ -1587,28 +2984,26 @@ class Roomba(object):
             self.timer('ignore_coordinates')
             current_mission = None  #force update of map
 
-        self.log.info('current_state: {}, current phase: {}, mission: {}, mission_min: {}, recharge_min: {}, co-ords changed: {}'.format(self.current_state,
-                                                                                                                    phase,
-                                                                                                                    mission,
-                                                                                                                    self.mssnM,
-                                                                                                                    self.rechrgM,
-                                                                                                                    self.changed('pose')))
+        if self.trace.isEnabledFor(logging.INFO):
+            # mssnM and rechrgM are only looked up if the line is logged
+            self.trace.info('current_state: %s, current phase: %s, mission: %s, mission_min: %s, recharge_min: %s, co-ords changed: %s',
+                            self.current_state, phase, mission, snapshot.mssnM, snapshot.rechrgM, self.changed('pose'))
 
         if phase == "charge":
             #self.set_history('pose', self.zero_pose())
             current_mission = None
             
         if self.current_state == self.states["new"] and phase != 'run':
-            self.log.info('waiting for run state for New Missions')
+            self.trace.info('waiting for run state for New Missions')
             if time.time() - self.timers['start'] >= 20:
                 self.log.warning('Timeout waiting for run state')
                 self.current_state = self.states[phase]
 
         elif phase == "run" and (self.is_set('ignore_run') or mission == 'none'):
-            self.log.info('Ignoring bogus run state')
+            self.trace.info('Ignoring bogus run state')
             
         elif phase == "charge" and mission == 'none' and self.is_set('ignore_run'):
-            self.log.info('Ignoring bogus charge/mission state')
+            self.trace.info('Ignoring bogus charge/mission state')
             self.update_history("cycle", self.previous('cycle'))
             
         elif phase in ["hmPostMsn","hmMidMsn", "hmUsrDock"]:
@@ -1619,19 +3014,19 @@ class Roomba(object):
             if mission != 'none':
                 self.current_state = self.states["new"]
                 self.timers['start'] = time.time()
-                if isinstance(self.sku, str) and self.sku[0].lower() in ['i', 's', 'm']:
+                if isinstance(snapshot.sku, str) and snapshot.sku[0].lower() in ['i', 's', 'm']:
                     #self.timer('ignore_coordinates', True, 30)  #ignore updates for 30 seconds at start of new mission
                     pass
             else:
                 self.timers.pop('start', None)
-                if self.bin_full:
+                if snapshot.bin_full:
                     self.current_state = self.states["cancelled"]
                 else:
                     self.current_state = self.states["completed"]
                 self.timer('ignore_run', True, 5)  #still get bogus 'run' states after mission complete.
             
-        elif phase == "charge" and self.rechrgM:
-            if self.bin_full:
+        elif phase == "charge" and snapshot.rechrgM:
+            if snapshot.bin_full:
                 self.current_state = self.states["pause"]
             else:
                 self.current_state = self.states["recharge"]
@@ -1648,7 +3043,7 @@ class Roomba(object):
         self.publish("state", self.current_state)
         
         if self.is_set('ignore_coordinates') and self.current_state != self.states["new"]:
-            self.log.info('Ignoring co-ordinate updates')
+            self.trace.info('Ignoring co-ordinate updates')
         else:
             self.draw_map(current_mission != self.current_state)
             
@@ -1696,7 +3091,7 @@ class Roomba(object):
                     image = self.make_blank_image()
         return image
         
-    def save_image(self, var, name='', final_name=None):
+    def save_image(self, var, name='', final_name=None, options=None):
         if var is None or '.' not in name:
             self.log.warning('invalid save_image attempt')
             return
@@ -1706,13 +3101,168 @@ class Roomba(object):
         if type == 'npy':
             np.save(filename, var)
         else:
-            var.save(filename, type.upper())
+            data = self.map_call(encode_image, var, type, **(options if options else {}))
+            with open(filename, 'wb') as f:
+                f.write(data)
+            # keep the encoded image for the web server
+            self.image_cache.put(os.path.splitext(final_name if final_name else name)[0],
+                                 data,
+                                 'image/{}'.format(image_formats.get(type, type).lower()))
  
         if final_name:
             new_filename = '{}/{}{}'.format(self.mapPath, self.roombaName, final_name)
             # try to avoid other programs reading file while writing it,
             # rename should be atomic.
             os.rename(filename, new_filename)
+            
+    def save_map(self, var, name='', final_name=None):
+        '''
+        save live map image using the map output options
+        '''
+        self.save_image(var, name, final_name, self.map_output)
+            
+    def set_map_output(self, format='png', compress_level=None, optimize=False,
+                             quantize=False, quality=None):
+        '''
+        set the file type of the live maps (png, webp or jpg) and the encoder
+        options used when saving them:
+        compress_level: png zlib level 0-9 (None is PIL default of 6), lower
+                        is faster, but bigger files
+        optimize:       png extra compression pass (slow)
+        quantize:       png with a 256 colour palette, much smaller files
+        quality:        jpg quality, or webp (lossless) compression effort
+        '''
+        format = format.lower().lstrip('.')
+        if format not in image_formats:
+            self.log.warning('MAP: unsupported map format: {}, using png'.format(format))
+            format = 'png'
+        self.map_ext = format
+        self.map_output = {'compress_level' : compress_level,
+                           'optimize'       : optimize,
+                           'quantize'       : quantize,
+                           'quality'        : quality}
+        self.log.info('MAP: live map format: {}, options: {}'.format(self.map_ext, self.map_output))
+            
+    def enable_map_writer(self, enable=True, max_fps=1.0):
+        '''
+        write live maps in a background thread, at most max_fps times a second
+        for each file (None or 0 is no limit). Only the latest map is written,
+        older pending maps are dropped. If not enabled, maps are written as
+        they are drawn.
+        '''
+        if not enable:
+            if self.map_writer:
+                self.map_writer.stop()
+            self.map_writer = None
+            return
+        if self.map_writer is None:
+            self.map_writer = map_writer(self.save_map, max_fps, log=self.log)
+        self.map_writer.max_fps = max_fps
+        self.log.info('MAP: background map writer enabled, max fps: {}'.format(max_fps))
+            
+    def enable_map_process(self, enable=True):
+        '''
+        encode map images and find map contours in a separate (worker)
+        process for this Roomba, instead of in this process. Uses more memory,
+        but several Roombas can draw maps in parallel, without slowing down
+        message processing.
+        '''
+        if not enable:
+            if self.map_process:
+                self.map_process.stop()
+            self.map_process = None
+            return
+        if not HAVE_SHM:
+            self.log.error('MAP: map process needs python 3.8 or later, drawing maps in this process')
+            return
+        if self.map_process is None:
+            from map_process import map_process
+            self.map_process = map_process('map_process_{}'.format(self.roombaName if self.roombaName else self.blid), log=self.log)
+        self.log.info('MAP: map process enabled')
+        
+    def enable_recorder(self, enable=True, path='.', chunk=256):
+        '''
+        record the pose, phase, battery, sqft and error of each mission to
+        <path>/<roombaName>mission_<start time>.rec (see recorder.py), chunk
+        is the number of rows written at a time.
+        '''
+        if not enable:
+            if self.recorder:
+                self.recorder.close()
+            self.recorder = self.record_path = None
+            return
+        self.record_path = path
+        self.record_chunk = chunk
+        self.log.info('Recording missions to: {}'.format(path))
+        
+    def record_mission(self, json_data):
+        '''
+        add a row to the mission recording, if json_data (a message) has
+        any of the recorded values. Recording starts when a mission (cycle)
+        starts, and the file is closed when the cycle goes back to none.
+        '''
+        if self.recorded_keys.isdisjoint(json_data.get('state', {}).get('reported', {})):
+            return
+        mission = self.mission
+        if self.recorder is None:
+            if mission in [None, 'none']:
+                return
+            from recorder import mission_recorder
+            filename = '{}/{}mission_{}.rec'.format(self.record_path, self.roombaName, time.strftime('%Y%m%d-%H%M%S'))
+            try:
+                self.recorder = mission_recorder(filename, name=self.roombaName, chunk=self.record_chunk, log=self.log)
+            except OSError as e:
+                self.log.error('Unable to record mission: {}'.format(e))
+                self.record_path = None
+                return
+        try:
+            full = self.recorder.add(self.pose, self.phase, self.batPct, self.get_property('sqft'), self.error_num)
+        except Exception as e:
+            # don't stop message processing
+            self.log.error('Unable to record mission: {}: {}'.format(type(e).__name__, e))
+            full = False
+        if mission in [None, 'none']:
+            # end of mission
+            recorder, self.recorder = self.recorder, None
+            self.record_job(recorder.close)
+        elif full:
+            self.record_job(self.recorder.flush)
+            
+    def record_job(self, func):
+        '''
+        run recorder func (flush or close) in the io executor, the recorder
+        writes chunks in order, and errors are logged
+        '''
+        future = self.loop.run_in_executor(self.get_executor('io'), func)
+        self.record_jobs.add(future)
+        future.add_done_callback(self.record_done)
+        
+    def record_done(self, future):
+        self.record_jobs.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            self.log.error('Mission recording error: {}'.format(future.exception()))
+        
+    def map_call(self, func, data, *args, **kwargs):
+        '''
+        return func(data, *args, **kwargs), run in the map process if it is
+        enabled (falls back to running it here if the map process fails)
+        '''
+        if self.map_process:
+            try:
+                return self.map_process.call(func, data, *args, **kwargs)
+            except Exception as e:
+                self.log.error('MAP: map process error in {}: {}'.format(func.__name__, e))
+        return func(data, *args, **kwargs)
+            
+    def queue_image(self, var, name='', final_name=None, copy=False):
+        '''
+        save image using the background map writer, if it's enabled, else
+        save it now. If var may be changed later, set copy to True.
+        '''
+        if self.map_writer is None:
+            self.save_map(var, name, final_name)
+        elif var is not None:
+            self.map_writer.put(var.copy() if copy else var, name, final_name)
         
     def load_existing_maps(self):
         self.base = self.load_image('lines.png')
@@ -1729,7 +3279,7 @@ class Roomba(object):
             self.roomba_problem = self.make_blank_image()
 
             self.previous_map_no_text = None
-            self.map_no_text = self.load_image('map_notext.png', True)
+            self.map_no_text = self.load_image('map_notext.{}'.format(self.map_ext), True)
         # save x and y center of image, for centering of final map image
         self.cx = self.base.size[0] // 2
         self.cy = self.base.size[1] // 2
@@ -1743,6 +3293,8 @@ class Roomba(object):
         self.dock_position = (
             self.home_pos[0] - self.icons['home'].size[0] // 2,
             self.home_pos[1] - self.icons['home'].size[1] // 2)
+        # icons or dock position may have changed
+        self.roomba_sprite = None
 
         self.log.info("MAP: Initialisation complete")
 
@@ -1750,9 +3302,8 @@ class Roomba(object):
         '''
         needed because PIL pasting of transparent images gives weird results
         '''
-        image = self.make_blank_image()
-        image.paste(icon,position)
-        base_image = Image.alpha_composite(base_image, image)
+        base_image = base_image.copy()
+        alpha_paste(base_image, icon, position if position else (0,0))
         return base_image
         
     def img_to_png(self, name):
@@ -1770,6 +3321,23 @@ class Roomba(object):
         imgBytes.seek(0)
         return imgBytes.read()
 
+    def get_encoded_image(self, name):
+        '''
+        return image_cache entry (png bytes, version, etag) for map layer
+        name. outline, floorplan and problems are only re-encoded if they have
+        changed, other names (eg map, map_notext, final_map) are the last
+        saved image.
+        '''
+        if name == 'outline':
+            image = self.room_outline
+        elif name == 'floorplan':
+            image = self.floorplan
+        elif name == 'problems':
+            image = self.roomba_problem
+        else:
+            return self.image_cache.get(name)
+        return self.image_cache.get(name, image, self.img_to_png)
+
     def zero_coords(self, theta=180):
         '''
         returns dictionary with default zero coords
@@ -1782,7 +3350,7 @@ class Roomba(object):
         '''
         return {"theta":theta,"point":{"x":0,"y":0}}
 
-    def offset_coordinates(self, new_co_ords):
+    def offset_coordinates(self, new_co_ords, save=True):
         '''
         offset coordinates according to mapSize settings, with 0,0 as center
         ''' 
@@ -1791,7 +3359,8 @@ class Roomba(object):
                new_co_ords["y"] + self.mapSize[1] // 2 + self.mapSize[3])
 
         theta = int(new_co_ords["theta"] - 90 + self.roomba_angle)
-        self.old_x_y = x_y  #save co-ordinates
+        if save:
+            self.old_x_y = x_y  #save co-ordinates
         
         return x_y, theta%360
 
@@ -1821,10 +3390,16 @@ class Roomba(object):
             self.log.warning('MAP: Not drawing line {}, {}: distance is greater than {}'.format(old_x_y, x_y, self.max_distance))
             return
         lines = ImageDraw.Draw(image)
+        width = self.icons['roomba'].size[0] // 2
+        if image is self.base:
+            self.map_compositor.add_dirty([min(old_x_y[0], x_y[0]) - width,
+                                           min(old_x_y[1], x_y[1]) - width,
+                                           max(old_x_y[0], x_y[0]) + width + 1,
+                                           max(old_x_y[1], x_y[1]) + width + 1])
         if x_y != old_x_y:
-            self.log.info("MAP: drawing line: {}, {}".format(old_x_y, x_y))
+            self.trace.info("MAP: drawing line: %s, %s", old_x_y, x_y)
             lines.line([old_x_y, x_y], fill=self.fillColor,
-                       width=self.icons['roomba'].size[0] // 2)
+                       width=width)
         #draw circle over roomba vacuum area to give smooth edges.
         arcbox = [x_y[0]-self.icons['roomba'].size[0] // 4,
                   x_y[1]-self.icons['roomba'].size[0] // 4,
@@ -1858,24 +3433,40 @@ class Roomba(object):
             
     def draw_roomba(self, roomba_pos, theta):
         '''
-        make a blank image for the text and Roomba overlay, initialized to
-        transparent text color
-        Paste various Roomba problem icons onto the problems image,
-        Paste roomba icon onto roomba_sprite image
+        Paste roomba icon onto roomba_sprite image (the Roomba overlay)
         Finally paste the dock icon over it
-        add optional debug info, and return the new roomba_sprite image
-        '''
-        roomba_sprite = self.make_blank_image()
-        self.log.info("MAP: drawing roomba: pos: {}, theta: {}".format(roomba_pos, theta))
-        
+        roomba_sprite is kept between updates, and only the area of the old
+        and new Roomba positions is redrawn (made transparent, and the icons
+        pasted again). In debug mode a new roomba_sprite is made every time.
+        add optional debug info, and return the roomba_sprite image
+        '''
+        self.trace.info("MAP: drawing roomba: pos: %s, theta: %s", roomba_pos, theta)
+        icon = self.icons.rotate('roomba', theta)
+        sprite_box = [roomba_pos[0], roomba_pos[1],
+                      roomba_pos[0] + icon.size[0], roomba_pos[1] + icon.size[1]]
+        
+        if self.debug or self.roomba_sprite is None or self.roomba_sprite.size != self.base.size:
+            self.roomba_sprite = self.make_blank_image()
+            redraw = None
+        else:
+            redraw = sprite_box
+            if self.sprite_box is not None:
+                redraw = [min(redraw[0], self.sprite_box[0]), min(redraw[1], self.sprite_box[1]),
+                          max(redraw[2], self.sprite_box[2]), max(redraw[3], self.sprite_box[3])]
+            # erase old roomba
+            self.roomba_sprite.paste(transparent, tuple(redraw))
+        roomba_sprite = self.roomba_sprite
+
         #draw roomba
-        roomba_sprite = self.transparent_paste(
-            roomba_sprite,
-            self.icons['roomba'].rotate(theta, expand=False), roomba_pos)
+        alpha_paste(roomba_sprite, icon, roomba_pos, redraw)
+        # re-composite old and new roomba positions
+        if self.sprite_box is not None:
+            self.map_compositor.add_dirty(self.sprite_box)
+        self.sprite_box = sprite_box
+        self.map_compositor.add_dirty(self.sprite_box)
 
         # paste dock over roomba_sprite
-        roomba_sprite = self.transparent_paste(
-            roomba_sprite, self.icons['home'], self.dock_position)
+        alpha_paste(roomba_sprite, self.icons['home'], self.dock_position, redraw)
             
         if self.debug:
             #draw bounding box, plus overlay co-ordinates on roomba_sprite
@@ -1892,6 +3483,12 @@ class Roomba(object):
         '''
         Paste various Roomba problem icons onto the problems image
         '''
+        if any(self.flags.get(flag) for flag in ['stuck', 'cancelled', 'bin_full', 'battery_low', 'tank_low']):
+            self.map_compositor.add_dirty([roomba_pos[0], roomba_pos[1],
+                                           roomba_pos[0] + self.icons['roomba'].size[0],
+                                           roomba_pos[1] + self.icons['roomba'].size[1]])
+            # problems image is changed in place
+            self.image_cache.invalidate('problems')
         if self.flags.get('stuck'):
             self.log.info("MAP: Drawing stuck Roomba")
             self.roomba_problem.paste(self.icons['stuck'],roomba_pos)
@@ -1912,18 +3509,22 @@ class Roomba(object):
         '''
         Draw map of Roomba cleaning progress
         '''
-        if (self.changed('pose') or self.changed('phase') or force_redraw) and self.drawmap:
+        #poses received since the map was drawn (the pose history only
+        #compares the last pose of a batch with the previous batch)
+        moved = len(self.intermediate_poses) > 1
+        if (self.changed('pose') or self.changed('phase') or force_redraw or moved) and self.drawmap:
+            snapshot = self.snapshot
             #program just started, initialize old_x_y
             if self.old_x_y is None:
-                self.old_x_y, _ = self.offset_coordinates(self.co_ords)
+                self.old_x_y, _ = self.offset_coordinates(self.intermediate_poses[0] if self.intermediate_poses else snapshot.co_ords)
             
             #set flags
             self.set_flags()
-            if not self.bin_full:
+            if not snapshot.bin_full:
                 self.clear_flags('bin_full')
                 
-            if self.tanklvl is not None:
-                if self.tanklvl < 100:
+            if snapshot.tanklvl is not None:
+                if snapshot.tanklvl < 100:
                     self.set_flags('tank_low')
                 else:
                     self.clear_flags('tank_low')
@@ -1936,19 +3537,22 @@ class Roomba(object):
         Actually draw the map
         '''
         draw_final = show_time =False
+        snapshot = self.snapshot    #properties of the last message
         #save self.old_x_y
         old_x_y = self.old_x_y
         #get x,y theta location note: this updates self.old_x_y with new x_y
-        x_y, theta = self.offset_coordinates(self.co_ords)
+        x_y, theta = self.offset_coordinates(snapshot.co_ords)
+        #poses received before this one (if messages were processed as a batch,
+        #or the map was not drawn), the last pose is the current pose
+        poses, self.intermediate_poses = self.intermediate_poses[:-1], []
 
-        if self.show_final_map == False:
-            self.log.info("MAP: received: new co-ords: {} "
-                          "phase: {}, state: {}".format(self.co_ords,
-                          self.phase, self.current_state))
+        if self.show_final_map == False and self.trace.isEnabledFor(logging.INFO):
+            self.trace.info("MAP: received: new co-ords: %s phase: %s, state: %s",
+                            snapshot.co_ords, snapshot.phase, self.current_state)
 
         if  self.current_state == self.states["charge"]:
             x_y = None
-            self.display_text = "Charging: Battery: {}%".format(self.batPct)
+            self.display_text = "Charging: Battery: {}%".format(snapshot.batPct)
             self.clear_flags(['battery_low', 'stuck'])
             if self.is_set('update_after_completed'):
                 self.log.info('not updating map/text (mission complete), resume in {}s'.format(self.when_run('update_after_completed')))
@@ -1958,12 +3562,12 @@ class Roomba(object):
 
         elif self.current_state == self.states["recharge"]:
             x_y = None
-            self.display_text = "Recharging: Time: {}m, Bat: {}%".format(self.rechrgM,self.batPct)
+            self.display_text = "Recharging: Time: {}m, Bat: {}%".format(snapshot.rechrgM,snapshot.batPct)
             self.clear_flags(['battery_low', 'stuck'])
             self.save_text_and_map_on_whitebg(self.map_no_text)
 
         elif self.current_state == self.states["pause"]:
-            self.display_text = "Paused: {}m, Bat: {}%".format(self.mssnM,self.batPct)
+            self.display_text = "Paused: {}m, Bat: {}%".format(snapshot.mssnM,snapshot.batPct)
             self.save_text_and_map_on_whitebg(self.map_no_text)
 
         elif self.current_state == self.states["hmPostMsn"]:
@@ -1981,21 +3585,22 @@ class Roomba(object):
             self.display_text = "Completed"
             show_time = True
             self.log.info("MAP: mission completed")
+            self.log.info("MAP: icon cache: {}".format(self.icons.cache_info()))
             self.draw_final_map(True)
             draw_final = True
             
         elif self.current_state == self.states["run"]:
-            self.display_text = '{} Time: {}m, Bat: {}%'.format(self.states["run"],self.mssnM,self.batPct)
+            self.display_text = '{} Time: {}m, Bat: {}%'.format(self.states["run"],snapshot.mssnM,snapshot.batPct)
             self.clear_flags(['stuck', 'new_mission'])
             self.show_final_map = False
-            if self.co_ords == self.zero_coords(theta=0):
+            if snapshot.co_ords == self.zero_coords(theta=0):
                 #bogus pose received, can't have 0,0,0 when running, usually happens after recovering from an error condition
                 self.log.warning('MAP: received 0,0,0 pose when running - ignoring')
                 self.old_x_y = None
                 return
 
         elif self.current_state == self.states["stop"]:
-            self.display_text = "Stopped: {}m, Bat: {}%".format(self.mssnM,self.batPct)
+            self.display_text = "Stopped: {}m, Bat: {}%".format(snapshot.mssnM,snapshot.batPct)
             self.show_final_map = False
 
         elif self.current_state == self.states["new"]:
@@ -2010,14 +3615,15 @@ class Roomba(object):
             self.show_final_map = False
             self.display_text = None
             self.timer('update_after_completed')
+            poses = []  #from the last mission
             self.log.info("MAP: created new image at start of new run")
             self.clear_flags()
             self.set_flags('new_mission')
 
         elif self.current_state == self.states["stuck"]:
-            expire = self.expireM
+            expire = snapshot.expireM
             expire_text = 'Job Cancel in {}m'.format(expire) if expire else 'Job Cancelled'
-            self.display_text = ("STUCK!: {} {}").format(self.error_message, expire_text)
+            self.display_text = ("STUCK!: {} {}").format(snapshot.error_message, expire_text)
             show_time = True
             self.draw_final_map(True)
             draw_final = True
@@ -2033,10 +3639,10 @@ class Roomba(object):
             self.display_text = "Docking"
             self.show_final_map = False
             if not self.is_set('ignore_run'):
-                if self.bin_full:
+                if snapshot.bin_full:
                     self.set_flags('bin_full')
                 else:
-                    self.display_text = "Battery low: {}%, {}".format(self.batPct,self.display_text)
+                    self.display_text = "Battery low: {}%, {}".format(snapshot.batPct,self.display_text)
                     self.set_flags('battery_low')             
                 
         elif self.current_state == self.states["hmUsrDock"]:
@@ -2054,7 +3660,7 @@ class Roomba(object):
         if self.display_text is None:
             self.display_text = self.current_state
             
-        if self.bin_full:
+        if snapshot.bin_full:
             self.display_text = "Bin Full: {}".format(self.display_text)
             
         #add date/time to display text
@@ -2062,7 +3668,7 @@ class Roomba(object):
             self.display_text = '{}: {}'.format(self.display_text, time.strftime("%a %b %d %H:%M:%S"))
         
         if self.show_final_map and not self.debug: #just display final map - not live
-            self.log.debug("MAP: not updating map - Roomba not running")
+            self.trace.debug("MAP: not updating map - Roomba not running")
             return
 
         if self.debug:
@@ -2071,16 +3677,25 @@ class Roomba(object):
             
         if x_y is None:
             #set zero co_ordinates if x_y is None
-            self.log.info("MAP: ignoring new co-ords in {} phase: {}".format(self.current_state, self.co_ords))
+            self.trace.info("MAP: ignoring new co-ords in %s phase: %s", self.current_state, snapshot.co_ords)
             x_y, theta = self.offset_coordinates(None)
             old_x_y = self.old_x_y
+            poses = []
             
         #calculate co-ordinates, with 0,0 as center
         roomba_pos = self.get_roomba_pos(x_y)
 
-        self.log.debug("MAP: old x,y: {} new x,y: {} theta: {} roomba pos: {}".format(old_x_y, x_y, theta, roomba_pos))
-
-        #draw lines
+        self.trace.debug("MAP: old x,y: %s new x,y: %s theta: %s roomba pos: %s", old_x_y, x_y, theta, roomba_pos)
+
+        #draw lines (through any earlier poses, so no coverage is lost)
+        for co_ords in poses:
+            if self.current_state == self.states["run"] and co_ords == self.zero_coords(theta=0):
+                #bogus pose, don't draw a line to or from it
+                old_x_y = None
+                continue
+            pose_x_y, _ = self.offset_coordinates(co_ords, save=False)
+            self.draw_vacuum_lines(self.base, old_x_y, pose_x_y, theta)
+            old_x_y = pose_x_y
         self.draw_vacuum_lines(self.base, old_x_y, x_y, theta)
         #draw roomba
         roomba_sprite = self.draw_roomba(roomba_pos, theta)
@@ -2092,43 +3707,51 @@ class Roomba(object):
             # x,y and angle if auto_rotate
             self.draw_room_outline(draw_final, x_y)
             
-        out = self.base
+        # base, floorplan, room outline, roomba lines (trail) and problem
+        # location for roomba
+        layers = [self.base,
+                  self.floorplan,
+                  self.room_outline if self.roomOutline else None,
+                  roomba_sprite,
+                  self.roomba_problem]
         
-        #merge floorplan into base
-        if self.floorplan is not None:
-            out = Image.alpha_composite(out, self.floorplan)
-            
-        # merge room outline into base
-        if self.roomOutline:
-            out = Image.alpha_composite(out, self.room_outline)
-            
-        #merge roomba lines (trail) with base
-        out = Image.alpha_composite(out, roomba_sprite)
-
-        #merge problem location for roomba into out
-        out = Image.alpha_composite(out, self.roomba_problem)
-
         if draw_final and self.auto_rotate:
+            out = layers[0]
+            for layer in layers[1:]:
+                if layer is not None:
+                    out = Image.alpha_composite(out, layer)
             #translate image to center it if auto_rotate is on
             out = self.transform_image(out)
-            
-        # map is upside down, so rotate 180 degrees, and size to fit
-        #(NW 12/4/2018 fixed bug causing distorted maps when rotation is not 0)
-        out_rotated = out.rotate(180, expand=False)
+            # map is upside down, so rotate 180 degrees, and size to fit
+            #(NW 12/4/2018 fixed bug causing distorted maps when rotation is not 0)
+            out_rotated = out.rotate(180, expand=False)
+            changed = None
+            self.map_compositor.invalidate()
+        else:
+            # only re-composite the area that has changed (rotated 180 degrees)
+            out_rotated, changed = self.map_compositor.render(layers)
         # save composite image
-        self.save_text_and_map_on_whitebg(out_rotated)
+        self.save_text_and_map_on_whitebg(out_rotated, changed)
         if draw_final:
             self.show_final_map = True  # prevent re-drawing of map until reset
 
-    def save_text_and_map_on_whitebg(self, map):
+    def save_text_and_map_on_whitebg(self, map, changed=None):
+        '''
+        save map, and map with text on a white background. changed is True if
+        map has been updated (map may be the same image updated in place), if
+        None, map is compared to the previous map.
+        '''
+        if changed is None:
+            changed = map is not self.previous_map_no_text and map != self.previous_map_no_text
         # if no map or nothing changed
-        if map is None or (map == self.previous_map_no_text and
+        if map is None or (not changed and
                            self.previous_display_text == self.display_text):
             return
         self.map_no_text = map
         self.previous_map_no_text = self.map_no_text
         self.previous_display_text = self.display_text
-        self.save_image(self.map_no_text, 'map_notext.png')
+        # map may be updated in place by the next render, so queue a copy
+        self.queue_image(self.map_no_text, 'map_notext.{}'.format(self.map_ext), copy=True)
         
         if self.enableMapWithText:
             final = self.make_blank_image(colour=(255,255,255,255))    # white
@@ -2138,7 +3761,7 @@ class Roomba(object):
             final = final.rotate(self.angle, expand=True) 
             # draw text
             self.draw_text(final, self.display_text, self.fnt)
-            self.save_image(final, '_map.png', 'map.png')
+            self.queue_image(final, '_map.{}'.format(self.map_ext), 'map.{}'.format(self.map_ext))
 
     def ScaleRotateTranslate(self, image, angle=0, center=None, new_center=None,
                                    scale=None, expand=False):
@@ -2184,11 +3807,9 @@ class Roomba(object):
                 img = Image.alpha_composite(self.base, self.room_outline)
                 edgedata = np.array(img.convert('L'))
                 # find external contour
-                _, contours, _ = self.findContours(
-                    edgedata,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
-                if len(contours) == 0 or contours[0] is None: return
-                if len(contours[0]) < 5: return
-                self.room_outline_contour = contours[0]
+                contour = self.map_call(outline_contour, edgedata)
+                if contour is None: return
+                self.room_outline_contour = contour
                 self.room_outline = self.make_new_outline_image(self.room_outline_contour)
         else:   #PIL
             if self.room_outline is None:# or overwrite:
@@ -2215,8 +3836,8 @@ class Roomba(object):
         '''
         if HAVE_CV2 and contour is not None:
             perimeter = cv2.arcLength(contour,True)
-            outline = self.make_blank_image()
-            edgeimage = np.array(outline)   # make blank RGBA image array
+            # blank RGBA image array
+            edgeimage = np.zeros((self.base.size[1], self.base.size[0], 4), dtype=np.uint8)
             # self.draw_edges is the max deviation from a line (set to 0.3%)
             # you can fiddle with this
             approx = cv2.approxPolyDP(contour, self.draw_edges * perimeter, True)
@@ -2339,14 +3960,7 @@ class Roomba(object):
         Version independent find contours routine. Works with OpenCV 2 or 3 or 4.
         Returns modified image (with contours applied), contours list, hierarchy
         '''
-        ver = int(cv2.__version__.split(".")[0])
-        im = image.copy()
-        if ver == 2 or ver == 4: #NW fix for OpenCV V4 21st Dec 2018
-            contours, hierarchy = cv2.findContours(im,mode,method)
-            return im, contours, hierarchy
-        else:
-            im_cont, contours, hierarchy = cv2.findContours(im,mode,method)
-            return im_cont, contours, hierarchy
+        return find_contours(image,mode,method)
 
     def draw_final_map(self, overwrite=False):
         '''
@@ -2358,34 +3972,18 @@ class Roomba(object):
             # NOTE: this is CPU intensive!
             edgedata = np.array(self.base.convert('L'), dtype=np.uint8)
             # find all contours
-            _, contours, _ = self.findContours(
-                edgedata,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
+            # self.draw_edges is the max deviation from a line
+            # you can fiddle with this in enable_map
+            result = self.map_call(final_map_contours, edgedata, self.draw_edges)
+            if result is None: return
+            approx, contours = result
             # zero edge data for later use
             edgedata.fill(0)
-            max_perimeter = 0
-            max_contour = None
-            for cnt in contours:
-                perimeter = cv2.arcLength(cnt,True)
-                if perimeter >= max_perimeter:
-                    max_contour = cnt   # get the contour with maximum length
-                    max_perimeter = perimeter
-            if max_contour is None: return
-            if len(max_contour) < 5: return
-            try:
-                contours.remove(max_contour)    # remove max contour from list
-            except ValueError:
-                self.log.warning("MAP: unable to remove contour")
-                pass
 
             mask = np.full(edgedata.shape, 255, dtype=np.uint8) # white
             # create mask (of other contours) in black
             cv2.drawContours(mask,contours, -1, 0, -1)
 
-            # self.draw_edges is the max deviation from a line
-            # you can fiddle with this in enable_map
-            approx = cv2.approxPolyDP(max_contour,
-                self.draw_edges * max_perimeter,True)
-
             bgimage = np.array(merge)   # make blank RGBA image array
             # draw contour and fill with "lawngreen" (default)
             cv2.drawContours(bgimage,[approx] , -1, self.fillColor, -1)
@@ -166,11 +166,53 @@ def parse_args():
         action='store_true',
         default = False,
         help='Output raw data to mqtt, no decoding of json data (default: %(default)s)')
+    parser.add_argument(
+        '-pu', '--publish_unchanged',
+        action='store_true',
+        default = False,
+        help='Publish every decoded value received, not just values that '
+             'have changed (default: %(default)s)')
+    parser.add_argument(
+        '-am', '--asyncio_mqtt',
+        action='store_true',
+        default = False,
+        help='Run MQTT connections on the asyncio loop, instead of a network '
+             'thread per connection (default: %(default)s)')
+    parser.add_argument(
+        '-ex', '--executors',
+        action='store',
+        type=str,
+        default=None,
+        help='Number of threads for each executor (shared by all Roombas), '
+             'eg "{\'render\':2, \'io\':4, \'control\':2, \'connect\':4}". '
+             'Use single quotes around the string. (default: %(default)s)')
+    parser.add_argument(
+        '-is', '--ingest_size',
+        action='store',
+        type=int,
+        default=1000,
+        help='Max number of received messages waiting to be processed '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-ip', '--ingest_policy',
+        action='store',
+        choices=['block', 'drop_oldest', 'coalesce'],
+        default='coalesce',
+        help='What to do with received messages when the queue is full, '
+             'block (wait for space), drop_oldest or coalesce (merge '
+             'messages with the same topic) (default: %(default)s)')
     parser.add_argument(
         '-j', '--pretty_print',
         action='store_true',
         default = False,
         help='pretty print json in logs (default: %(default)s)')
+    parser.add_argument(
+        '-nt', '--no_trace',
+        action='store_true',
+        default = False,
+        help="Don't log received data, state machine and map drawing for "
+             "every message (replay_log.py needs this in the log) "
+             "(default: %(default)s)")
     parser.add_argument(
         '-m', '--drawmap',
         action='store_false',
@@ -199,6 +241,35 @@ def parse_args():
              '0 is the rotation of the roomba. '
              'Use single quotes around the string. (default: '
              '"%(default)s")')
+    parser.add_argument(
+        '-mf', '--map_max_fps',
+        action='store',
+        type=float,
+        default=None,
+        help='Write maps in the background, at most this many times a second '
+             '(only the latest map is written), None writes every map as it '
+             'is drawn (default: %(default)s)')
+    parser.add_argument(
+        '-mp', '--map_process',
+        action='store_true',
+        default = False,
+        help='Encode maps and find map outlines in a separate process for '
+             'each Roomba (default: %(default)s)')
+    parser.add_argument(
+        '-rm', '--record_missions',
+        action='store_true',
+        default = False,
+        help='Record the pose, phase, battery, sqft and error of each '
+             'mission to a binary file in mappath (default: %(default)s)')
+    parser.add_argument(
+        '-mo', '--map_output',
+        action='store',
+        type=str,
+        default=None,
+        help='Live map file type and encoder options, '
+             'eg "{\'format\':\'png\', \'compress_level\':1, \'quantize\':True}", '
+             'format can be png, webp (lossless) or jpg. '
+             'Use single quotes around the string. (default: %(default)s)')
     parser.add_argument(
         '-fp', '--floorplan',
         action='store',
@@ -291,10 +362,10 @@ def main():
                 </script>
 
                 <body>
-                <img id="img" src="{}map.png" alt="Roomba Map Live" style="position:absolute;top:0;left:0"/>
+                <img id="img" src="{}map.{}" alt="Roomba Map Live" style="position:absolute;top:0;left:0"/>
                 </body>
                 </html>
-                '''.format(myroomba.roombaName)
+                '''.format(myroomba.roombaName, myroomba.map_ext)
                 
         def write_file(fname, data, mode=0o666):
             if not os.path.isfile(fname):
@@ -387,6 +458,10 @@ def main():
                                    "password": arg.password,
                                    "roomba_name": arg.roomba_name}}
                                    
+    if arg.executors:
+        # executors are shared by all Roombas
+        Roomba.set_executors(**literal_eval(arg.executors))
+                                   
     roomba_list = []
     for addr, info in roombas.items():
         log.info("Creating Roomba object {}, {}".format(addr, info.get("roomba_name", addr)))
@@ -419,9 +494,17 @@ def main():
         myroomba.set_options(raw=arg.raw,
                              indent=arg.indent,
                              pretty_print=arg.pretty_print,
-                             max_sqft=arg.max_sqft)
+                             max_sqft=arg.max_sqft,
+                             publish_unchanged=arg.publish_unchanged)
+        myroomba.set_ingest(size=arg.ingest_size, policy=arg.ingest_policy)
+        myroomba.set_trace(not arg.no_trace)
+        myroomba.set_mqtt_transport(use_asyncio=arg.asyncio_mqtt)
+        if arg.record_missions:
+            myroomba.enable_recorder(path=arg.mappath)
             
         if arg.mappath and arg.mapsize and arg.drawmap:
+            if arg.map_output:
+                myroomba.set_map_output(**literal_eval(arg.map_output))
             # auto create html files (if they don't exist)
             create_html(myroomba, arg.mappath)
             # enable live maps, class default is no maps
@@ -431,6 +514,10 @@ def main():
                                 iconPath=arg.iconpath,
                                 roomOutline=arg.room_outline,
                                 floorplan=arg.floorplan)
+            if arg.map_max_fps:
+                myroomba.enable_map_writer(max_fps=arg.map_max_fps)
+            if arg.map_process:
+                myroomba.enable_map_process()
                                 
         if arg.broker is not None:
             # if you want to publish Roomba data to your own mqtt broker
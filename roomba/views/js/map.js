@@ -38,6 +38,7 @@ var rotation = 0;
 var invert_x = 0;
 var invert_y = 0;
 var updateEvery = 3000;
+var missionStream = null;   //EventSource, false if not supported by server
 var lineWidth = 20;
 var maxDim  = 0;
 var gXoff = 0;
@@ -160,33 +161,49 @@ function getDimentions () {
   gYoff = (maxDim - sizeY)/2;
 }
 
-function getMapOutline () {
-  $.get('/api/local/map/outline', function( data ) {
-    var pngimg = data;
-    console.log('got outline image, length: %d',pngimg.length);
-    //console.log(pngimg)
-    if (pngimg) {
-      outline.src = "data:image/png;base64," + pngimg;
-      textLayerContext.drawImage(outline, 0, (textLayer.height/2)-(outline.naturalHeight/2));
-    } else {
-      var elem = document.getElementById('clearoutline');
-      if (elem !== null) {
-        //remove clearoutline button if null
-        elem.parentNode.removeChild(elem);
+function loadImage (img, url, onload, onerror) {
+  //load binary image from url into img, the server is asked every time
+  //but only sends the image if it has changed (ETag)
+  fetch(url, {cache: 'no-cache'})
+    .then(function (response) {
+      if (!response.ok) {
+        throw new Error(url + ' ' + response.status);
+      }
+      return response.blob();
+    })
+    .then(function (blob) {
+      if (img.src.startsWith('blob:')) {
+        URL.revokeObjectURL(img.src);
+      }
+      img.onload = onload;
+      img.src = URL.createObjectURL(blob);
+    })
+    .catch(function (error) {
+      console.log('image not loaded: %s', error);
+      if (onerror) {
+        onerror();
       }
+    });
+}
+
+function getMapOutline () {
+  loadImage(outline, '/api/local/image/outline', function () {
+    console.log('got outline image, size: %dx%d', outline.naturalWidth, outline.naturalHeight);
+    textLayerContext.drawImage(outline, 0, (textLayer.height/2)-(outline.naturalHeight/2));
+  }, function () {
+    var elem = document.getElementById('clearoutline');
+    if (elem !== null) {
+      //remove clearoutline button if no outline
+      elem.parentNode.removeChild(elem);
     }
   });
 }
 
 function getFloorplan () {
-  $.get('/api/local/map/floorplan', function( data ) {
-    floorplan_data = data;
-    console.log('got floorplan image, length: %d',floorplan_data.length);
-    //console.log(floorplan_data)
-    if (floorplan_data) {
-      floorplan.src = "data:image/png;base64," + floorplan_data;
-      clearOutline();
-    } 
+  loadImage(floorplan, '/api/local/image/floorplan', function () {
+    floorplan_data = true;
+    console.log('got floorplan image, size: %dx%d', floorplan.naturalWidth, floorplan.naturalHeight);
+    clearOutline();
   });
 }
 
@@ -245,11 +262,48 @@ function UpdateLineWidth () {
 }
 
 function startMissionLoop () {
+  //mission updates are pushed by the server, if the browser or server
+  //does not support it, poll every updateEvery ms
+  if (mapping && window.EventSource && missionStream !== false) {
+    startMissionStream();
+  } else {
+    pollMission();
+  }
+}
+
+function startMissionStream () {
+  if (missionStream) {
+    return;
+  }
+  $('#mapStatus').html('waiting for point...');
+  missionStream = new EventSource('/api/local/stream/mission');
+  missionStream.onmessage = function (event) {
+    messageHandler(JSON.parse(event.data));
+  };
+  missionStream.onerror = function () {
+    //closed means the server does not stream, otherwise it reconnects
+    if (missionStream.readyState == EventSource.CLOSED) {
+      console.log('mission stream not available, polling');
+      missionStream = false;
+      pollMission();
+    }
+  };
+}
+
+function stopMissionStream () {
+  if (missionStream) {
+    missionStream.close();
+    missionStream = null;
+  }
+  $('#mapStatus').html('stopped');
+}
+
+function pollMission () {
   if (mapping) {
     $('#mapStatus').html('getting point...');
     $.get('/api/local/info/mission', function (data) {
       messageHandler(data);
-      setTimeout(startMissionLoop, updateEvery);
+      setTimeout(pollMission, updateEvery);
     });
   } else {
     $('#mapStatus').html('stopped');
@@ -460,7 +514,11 @@ function drawOutline () {
 
 function toggleMapping () {
   mapping = !mapping;
-  if (mapping) startMissionLoop();
+  if (mapping) {
+    startMissionLoop();
+  } else {
+    stopMissionStream();
+  }
 }
 
 function toggleFPsize () {
@@ -7,6 +7,7 @@ Roomba api web server
 import asyncio
 from aiohttp import web
 import base64
+import json
 import logging
 
 
@@ -70,6 +71,8 @@ class webserver():
                  'alwaysfinish/off'         : {'binPause': True}
                 }
 
+    image_layers = ['outline', 'floorplan', 'problems', 'map', 'map_notext', 'final_map']
+
     def __init__(self, roomba=None, webport=None, log=None):
         self.roomba = roomba if roomba else self.dummy_roomba()
         if log:
@@ -80,6 +83,8 @@ class webserver():
         self.webport = webport
         self.app = None
         self.web_task = None
+        self.streams = set()
+        self.keepalive = 15     #seconds between stream keepalives
         self.start_web()
         #except aiohttp.web_runner.GracefulExit:
     
@@ -140,15 +145,21 @@ class webserver():
                 return web.Response(text="ok")
             elif item == 'outline':
                 if not self.roomba.roomOutline:
-                    img = None
-                else:
-                    img = self.roomba.img_to_png(self.roomba.room_outline)
-                return web.Response(body=self.b64_encode(img))
+                    return web.Response(body=None)
+                return self.image_response(request, item, b64=True)
             elif item == 'floorplan':
-                img = self.roomba.img_to_png(self.roomba.floorplan)
-                return web.Response(body=self.b64_encode(img))
+                return self.image_response(request, item, b64=True)
             raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
         
+        @routes.get('/api/local/image/{layer}')
+        async def image(request):
+            layer = request.match_info['layer']
+            if layer not in self.image_layers:
+                raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
+            if layer == 'outline' and not self.roomba.roomOutline:
+                raise web.HTTPNotFound(reason='room outline is not enabled')
+            return self.image_response(request, layer)
+            
         @routes.get('/api/local/info/{info}')
         async def info(request):
             item = request.match_info['info']
@@ -158,6 +169,45 @@ class webserver():
                 return web.json_response(value)
             raise web.HTTPBadRequest(reason='bad api call {}'.format(str(request.rel_url)))
 
+        @routes.get('/api/local/stream/{info}')
+        async def stream(request):
+            '''
+            Server Sent Events stream of info (eg mission), the current
+            value is sent on connect, then again every time a message from
+            the roomba updates one of the items.
+            '''
+            item = request.match_info['info']
+            items = self.get_items(item)
+            if not isinstance(items, list):
+                items = [items]
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                                   'Cache-Control': 'no-cache'})
+            await response.prepare(request)
+            queue = self.roomba.subscribe()
+            self.streams.add(queue)
+            self.log.info('stream {} started'.format(item))
+            try:
+                event = await self.send_event(response, items)
+                while True:
+                    try:
+                        json_data = await asyncio.wait_for(queue.get(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        await response.write(b': keepalive\n\n')
+                        continue
+                    # only send the latest value, if messages have queued up
+                    while json_data is not None and not queue.empty():
+                        json_data = queue.get_nowait()
+                    if json_data is None:
+                        break
+                    event = await self.send_event(response, items, event)
+            except (ConnectionResetError, asyncio.CancelledError):
+                pass
+            finally:
+                self.streams.discard(queue)
+                self.roomba.unsubscribe(queue)
+                self.log.info('stream {} stopped'.format(item))
+            return response
+                
         @routes.get('/api/local/action/{command}')
         async def action(request):
             command = request.match_info['command']
@@ -176,7 +226,7 @@ class webserver():
         async def config(request):
             config = request.match_info['config']
             config = self.get_items(config)
-            value = await self.loop.run_in_executor(None, self.roomba.get_property, config)
+            value = await self.loop.run_in_executor(self.roomba.get_executor('control'), self.roomba.get_property, config)
             return web.json_response(value)
             
         @routes.get('/api/local/config/{config}/{setting}')
@@ -240,12 +290,30 @@ class webserver():
         '''
         shutdown web server
         '''
+        for queue in self.streams:
+            # end streams
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
         if self.app:
             await self.app.shutdown()
             await self.app.cleanup()
         if self.web_task and not self.web_task.done():
             self.web_task.cancel()
         
+    async def send_event(self, response, items, last=None):
+        '''
+        send the current value of items, if it is not the same as last (the
+        last event sent). Values are compared as served (not just the keys in
+        the message), as some (eg flags, state) are derived from the message.
+        Returns the event sent (or last).
+        '''
+        value = {item: self.roomba.get_property(item) for item in items}
+        event = 'data: {}\n\n'.format(json.dumps(value))
+        if event != last:
+            await response.write(event.encode())
+        return event
+        
     def get_items(self, request):
         return self.api_get.get(request, request)
         
@@ -253,6 +321,31 @@ class webserver():
         key = '/'.join([setting, value])
         return self.api_post.get(key, {})
         
+    def image_response(self, request, name, b64=False):
+        '''
+        respond with cached encoded image name, or 304 Not Modified if the
+        client already has this version (If-None-Match matches the ETag)
+        '''
+        entry = self.roomba.get_encoded_image(name)
+        if entry is None:
+            raise web.HTTPNotFound(reason='no {} image'.format(name))
+        headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache'}
+        if self.etag_match(request, entry.etag):
+            return web.Response(status=304, headers=headers)
+        if b64:
+            return web.Response(body=entry.b64, headers=headers)
+        return web.Response(body=entry.data, content_type=entry.content_type, headers=headers)
+        
+    def etag_match(self, request, etag):
+        '''
+        True if etag is in the request If-None-Match header
+        '''
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        
     def b64_encode(self, img):
         b64img = None
         if img is not None:
@@ -281,6 +374,15 @@ class webserver():
         def img_to_png(self, name):
             return None
             
+        def get_encoded_image(self, name):
+            return None
+            
+        def subscribe(self, maxsize=100):
+            return asyncio.Queue(maxsize)
+            
+        def unsubscribe(self, queue):
+            return None
+            
         def clear_outline(self):
             return None
         
@@ -293,6 +395,9 @@ class webserver():
         def get_property(self, *args):
             return self.response
             
+        def get_executor(self, name):
+            return None
+            
         async def async_set_preference(self, *args):
             return None
     
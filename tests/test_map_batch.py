@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+The live map must be the same whether messages are processed one at a time,
+or as batches (when messages queue up faster than they are processed).
+'''
+
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roomba'))
+
+from roomba import Roomba, HAVE_PIL
+
+icon_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roomba', 'res')
+
+class message():
+    def __init__(self, payload, topic='$aws/things/blid/shadow/update'):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode()
+
+def mission(poses=60, seed=1):
+    '''
+    messages for a mission that is already running (eg after reconnecting),
+    the first pose is only drawn once the next pose is received
+    '''
+    random.seed(seed)
+    messages = [{"state":{"reported":{"cleanMissionStatus":{"cycle":"clean","phase":"run","mssnM":5,"error":0,"rechrgM":0},
+                                      "batPct":90,"bin":{"present":True,"full":False}}}}]
+    x = y = 0
+    for i in range(poses):
+        x = max(-300, min(300, x + random.randint(-30, 30)))
+        y = max(-300, min(300, y + random.randint(-30, 30)))
+        messages.append({"state":{"reported":{"pose":{"theta":random.randint(-179, 180),"point":{"x":x,"y":y}}}}})
+        if i % 10 == 0:
+            messages.append({"state":{"reported":{"batPct":100-i//10, "signal":{"rssi":-40-i%7}}}})
+    return messages
+
+@unittest.skipUnless(HAVE_PIL, 'PIL is needed to draw maps')
+class TestMapBatch(unittest.TestCase):
+
+    def draw(self, batched):
+        '''
+        draw the mission map, return the map image (bytes) and the lines
+        drawn
+        '''
+        async def run(map_path):
+            roomba = Roomba('127.0.0.1', 'blid', 'password', roombaName='test')
+            roomba._enable_map(enable=True, mapSize=(800,800,0,0,0,0), mapPath=map_path, iconPath=icon_path,
+                               roomOutline=False, enableMapWithText=False)
+            lines = []
+            draw_vacuum_lines = roomba.draw_vacuum_lines
+            def count_lines(image, old_x_y, x_y, *args, **kwargs):
+                if old_x_y is not None:
+                    lines.append((old_x_y, x_y))
+                return draw_vacuum_lines(image, old_x_y, x_y, *args, **kwargs)
+            roomba.draw_vacuum_lines = count_lines
+            for msg in mission():
+                await roomba.q.put(message(msg))
+                if not batched:
+                    await roomba.q.join()
+            await roomba.q.join()
+            return roomba.base.tobytes(), lines
+
+        with tempfile.TemporaryDirectory() as map_path:
+            return asyncio.run(run(map_path))
+
+    def test_batched_map_is_unbatched_map(self):
+        base, lines = self.draw(batched=False)
+        batched_base, batched_lines = self.draw(batched=True)
+        self.assertEqual(len(lines), 61)   #from the dock, then through each pose
+        self.assertEqual(batched_lines, lines)
+        self.assertTrue(batched_base == base, 'batched map is not the same as the unbatched map')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+A mission recording must read back the rows that were added, and a value
+that doesn't fit its column must not leave the columns of a chunk uneven.
+'''
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roomba'))
+
+from recorder import mission_recorder, mission_reader
+
+def pose(x, y, theta):
+    return {'theta': theta, 'point': {'x': x, 'y': y}}
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'mission.rec')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        recorder = mission_recorder(self.filename, name='T', chunk=4)
+        added = []
+        for i in range(10):
+            phase = 'run' if i < 7 else 'hmPostMsn'
+            full = recorder.add(pose(i * 10, -i * 5, i - 5), phase, 90 - i, i, 0, timestamp=1000.0 + i)
+            added.append({'time': 1000.0 + i, 'x': i * 10, 'y': -i * 5, 'theta': i - 5,
+                          'phase': phase, 'batPct': 90 - i, 'sqft': i, 'error': 0})
+            if full:
+                recorder.flush()
+        recorder.add(None, 'charge', None, None, None, timestamp=1010.0)
+        added.append({'time': 1010.0, 'x': None, 'y': None, 'theta': None,
+                      'phase': 'charge', 'batPct': None, 'sqft': None, 'error': None})
+        recorder.close()
+        with mission_reader(self.filename) as reader:
+            self.assertEqual(reader.meta['name'], 'T')
+            self.assertEqual(len(reader), len(added))
+            self.assertEqual(list(reader.rows()), added)
+            poses = list(reader.poses())
+            self.assertEqual(len(poses), 10)
+            self.assertEqual(poses[3], (1003.0, pose(30, -15, -2)))
+
+    def test_values_converted(self):
+        recorder = mission_recorder(self.filename, chunk=100)
+        recorder.add(pose(1.7, -2.2, 45.9), 'run', 99.5, 10**12, 'not a number', timestamp=5)
+        recorder.add(pose(1, 2, -10**6), None, float('nan'), -10**12, 3, timestamp=6)
+        lengths = {len(values) for values in recorder.rows.values()}
+        self.assertEqual(lengths, {2})
+        recorder.close()
+        with mission_reader(self.filename) as reader:
+            rows = list(reader.rows())
+        self.assertEqual(rows[0], {'time': 5.0, 'x': 1, 'y': -2, 'theta': 45, 'phase': 'run',
+                                   'batPct': 99, 'sqft': 2**31 - 1, 'error': None})
+        self.assertEqual(rows[1], {'time': 6.0, 'x': 1, 'y': 2, 'theta': -2**15 + 1, 'phase': None,
+                                   'batPct': None, 'sqft': -2**31 + 1, 'error': 3})
+
+if __name__ == '__main__':
+    unittest.main()